@@ -0,0 +1,167 @@
+#!/usr/bin/env python2
+""" Compare N accounts under the supervisor with N independent single-account processes """
+from argparse import ArgumentParser
+from os.path import dirname, abspath, join
+from signal import SIGINT
+from tempfile import mkdtemp
+from time import time, sleep, strftime, localtime
+import subprocess
+import random
+import sys
+import os
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from core import db
+import fixtures
+import fakes
+
+_RC = """[SCHEDULE]
+dynamic_enabled = False
+window_start = {later}
+window_duration = 1200
+[TWEET_QUOTA]
+count = 30
+delta = 1
+joke_align = 3
+expire_delta = 86400
+[BITLY_KEYS]
+user = bench
+key = bench
+endpoint = {shortener}
+[CALAIS_KEYS]
+key = bench
+[RESOURCES]
+dbschema = {dbschema}
+pidfile = {tmp}/pid
+[THREADS]
+queue_size = 100
+atom_query_delta = 0
+workers = {workers}
+"""
+
+_ACCOUNT = """[{section}]
+app = bench
+cred_path = {tmp}/creds
+key = {name}
+secret = bench
+"""
+
+
+def _tree(pid):
+    """ pid and every process below it """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit(): continue
+        try:
+            with open("/proc/{0}/stat".format(entry)) as fid:
+                ppid = int(fid.read().rsplit(")", 1)[1].split()[1])
+        except IOError:
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    found, todo = [], [pid]
+    while todo:
+        p = todo.pop()
+        found.append(p)
+        todo.extend(children.get(p, []))
+    return found
+
+
+def _usage(pids):
+    """ (RSS in MB, OS threads) summed over pids """
+    rss = threads = 0
+    for pid in pids:
+        try:
+            with open("/proc/{0}/status".format(pid)) as fid:
+                for line in fid:
+                    if line.startswith("VmRSS:"): rss += int(line.split()[1])
+                    if line.startswith("Threads:"): threads += int(line.split()[1])
+        except IOError:
+            pass
+    return rss / 1024.0, threads
+
+
+def _install(tmp, name, feeds, host, subscriptions):
+    dbschema = "sqlite:///{0}".format(join(tmp, name + ".db"))
+    db.install(dbschema)
+    session = db.Session(dbschema)
+    for n in feeds:
+        session.add(db.RssFeed(name="feed{0}".format(n), url=host.feed_url("feed{0}".format(n)), hashtags="",
+                               order=n, enable=True,
+                               subscriptions=[db.FeedAccount(account=a) for a in subscriptions.get(n, [])]))
+    session.commit()
+    session.close()
+    return dbschema
+
+
+def _run(rcs, seconds):
+    procs = [subprocess.Popen([sys.executable, join(ROOT, "twitterbot.py"), "-config", rc],
+                              stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT) for rc in rcs]
+    sleep(seconds)
+    rss, threads = _usage([pid for proc in procs for pid in _tree(proc.pid)])
+    for proc in procs: proc.send_signal(SIGINT)
+    for proc in procs: proc.wait()
+    return rss, threads
+
+
+def main(args):
+    ap = ArgumentParser(description="Benchmark the multi-account supervisor")
+    ap.add_argument("-accounts", help="Number of accounts.", type=int, default=20)
+    ap.add_argument("-feeds", help="Number of distinct feeds.", type=int, default=30)
+    ap.add_argument("-per", help="Feeds each account tweets.", type=int, default=5)
+    ap.add_argument("-workers", help="Supervisor worker processes.", type=int, default=2)
+    ap.add_argument("-seconds", help="How long each mode runs.", type=int, default=15)
+    _args = ap.parse_args(args)
+
+    tmp = mkdtemp()
+    with open(join(tmp, "creds"), "w") as fid: fid.write("bench\nbench\n")
+    later = strftime("%H:%M:%S", localtime(time() + 6 * 3600))
+
+    random.seed(1)
+    names = ["acct{0}".format(n) for n in range(_args.accounts)]
+    chosen = dict((name, random.sample(range(_args.feeds), _args.per)) for name in names)
+    subscriptions = {}
+    for name, feeds in chosen.items():
+        for n in feeds: subscriptions.setdefault(n, []).append(name)
+
+    host = fakes.FakeFeedHost(dict(("feed{0}".format(n), fixtures.rss("feed{0}".format(n), 10, base="http://example.com/{0}".format(n)))
+                                   for n in range(_args.feeds)))
+    shortener = fakes.FakeShortener()
+    host.start()
+    shortener.start()
+
+    try:
+        ## One config with an [ACCOUNT] section per account
+        rc = join(tmp, "supervised.rc")
+        with open(rc, "w") as fid:
+            fid.write(_RC.format(later=later, shortener=shortener.url, tmp=tmp, workers=_args.workers,
+                                 dbschema=_install(tmp, "supervised", range(_args.feeds), host, subscriptions)))
+            for name in names:
+                fid.write(_ACCOUNT.format(section="ACCOUNT " + name, name=name, tmp=tmp))
+        supervised = _run([rc], _args.seconds)
+        supervised += (host.requests, shortener.requests)
+        host.requests = shortener.requests = 0
+
+        ## One process, config and database per account
+        rcs = []
+        for name in names:
+            rc = join(tmp, name + ".rc")
+            with open(rc, "w") as fid:
+                fid.write(_RC.format(later=later, shortener=shortener.url, tmp=tmp, workers=1,
+                                     dbschema=_install(tmp, name, chosen[name], host, {})))
+                fid.write(_ACCOUNT.format(section="TWITTER_KEYS", name=name, tmp=tmp))
+            rcs.append(rc)
+        independent = _run(rcs, _args.seconds) + (host.requests, shortener.requests)
+    finally:
+        host.stop()
+        shortener.stop()
+
+    print("{0} accounts, {1} feeds, {2} feeds per account".format(_args.accounts, _args.feeds, _args.per))
+    for label, (rss, threads, fetches, shortens) in [("supervised", supervised), ("independent", independent)]:
+        print("{0:12}: {1:7.1f} MB RSS, {2:4} threads, {3:4} feed fetches, {4:4} shortener calls".format(
+            label, rss, threads, fetches, shortens))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,105 @@
+#!/usr/bin/env python2
+""" Time db.compact and check which atoms it archives with and without accounts
+
+Single account atoms carry their own status. With accounts the shared Atom
+stays RECIEVED and each AccountAtom carries the status, and atoms no
+account subscribes to go through AccountRouter.route like the feed stage.
+"""
+from argparse import ArgumentParser
+from os.path import dirname, abspath, join
+from tempfile import mkdtemp
+from time import time
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from core import db, accounts
+
+_HORIZON = 86400
+
+
+def seed(dbschema, atoms, names):
+    """ Returns:
+        The (Atom, AccountAtom) rows compact should leave behind
+    """
+    session = db.Session(dbschema)
+    single = db.RssFeed(name="single", url="http://example.com/single.xml", order=1, enable=True)
+    shared = db.RssFeed(name="shared", url="http://example.com/shared.xml", order=2, enable=True)
+    idle = db.RssFeed(name="idle", url="http://example.com/idle.xml", order=3, enable=True)
+    session.add_all([single, shared, idle])
+    session.flush()
+    for name in names: session.add(db.FeedAccount(feed_id=shared.id, account=name))
+    session.commit()
+
+    old = int(time()) - 2 * _HORIZON
+    statuses = [db.SENT, db.DROPPED, db.SKIPPED, db.WAIT]
+    engine = db.get_engine(dbschema)
+
+    ## Single account: every fourth atom is still waiting
+    engine.execute(db.Atom.__table__.insert(), [dict(
+        feed_id=single.id, uniq_id="single{0}".format(n), recv_dts=old, status=statuses[n % 4],
+    ) for n in range(atoms)])
+
+    ## Accounts: every fourth atom is still waiting on its last account
+    engine.execute(db.Atom.__table__.insert(), [dict(
+        feed_id=shared.id, uniq_id="shared{0}".format(n), recv_dts=old, status=db.RECIEVED,
+    ) for n in range(atoms)])
+    engine.execute(db.AccountAtom.__table__.insert(), [dict(
+        account=name, uniq_id=db.account_ident(name, "shared{0}".format(n)), atom_uniq_id="shared{0}".format(n),
+        recv_dts=old, status=db.WAIT if n % 4 == 3 and m == len(names) - 1 else statuses[(n + m) % 3],
+    ) for n in range(atoms) for m, name in enumerate(names)])
+
+    ## Accounts: nobody subscribes to the idle feed
+    items = [dict(ident="idle{0}".format(n), feed_id=idle.id, recv=old) for n in range(atoms)]
+    for item in items:
+        session.add(db.Atom(feed_id=idle.id, uniq_id=item['ident'], recv_dts=old, status=db.RECIEVED))
+    accounts.AccountRouter(names, [None]).route(session, items)
+    session.commit()
+    session.close()
+
+    waiting = atoms // 4
+    return 2 * waiting, waiting * len(names)
+
+
+def main(args):
+    ap = ArgumentParser(description="Benchmark and check atom compaction with and without accounts")
+    ap.add_argument("-atoms", help="Atoms of each kind to seed.", type=int, default=20000)
+    ap.add_argument("-accounts", help="Accounts subscribed to the shared feed.", type=int, default=3)
+    ap.add_argument("-batch", help="Atoms to archive in each transaction.", type=int, default=500)
+    _args = ap.parse_args(args)
+
+    dbschema = "sqlite:///" + join(mkdtemp(), "bench.db")
+    db.install(dbschema)
+    names = ["account{0}".format(n) for n in range(_args.accounts)]
+
+    print("Seeding {0} atoms of each kind for {1} accounts...".format(_args.atoms, _args.accounts))
+    expected = seed(dbschema, _args.atoms, names)
+
+    session = db.Session(dbschema)
+    before = int(time()) - _HORIZON
+    archived = purged = 0
+    start = time()
+    while True:
+        atoms, account_atoms = db.compact(session, before, _args.batch)
+        session.commit()
+        if not (atoms or account_atoms): break
+        archived += atoms
+        purged += account_atoms
+    elapsed = time() - start
+
+    left = (session.query(db.func.count(db.Atom.id)).scalar(),
+            session.query(db.func.count(db.AccountAtom.id)).scalar())
+    stuck = session.query(db.func.count(db.AccountAtom.id)).filter(
+        ~db.exists().where(db.Atom.uniq_id == db.AccountAtom.atom_uniq_id)).scalar()
+    session.close()
+
+    print("Archived {0} atoms and removed {1} account atoms in {2:.2f}s ({3:.0f} atoms/s)".format(
+        archived, purged, elapsed, archived / elapsed if elapsed else 0))
+    print("Left {0} atoms and {1} account atoms, expected {2} and {3}".format(left[0], left[1], *expected))
+    if left != expected or stuck:
+        print("MISMATCH: {0} account atoms outlived their archived atom".format(stuck) if stuck else "MISMATCH")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,72 @@
+#!/usr/bin/env python2
+""" Measure the cost of polling a feed against a large Atom history """
+from argparse import ArgumentParser
+from os.path import dirname, abspath, join
+from tempfile import mkdtemp
+from time import time
+import hashlib
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from core import db
+import fixtures
+
+
+def seed(dbschema, feed_id, rows, batch=50000):
+    engine = db.get_engine(dbschema)
+    table = db.Atom.__table__
+    now = int(time())
+    for i in range(0, rows, batch):
+        engine.execute(table.insert(), [dict(
+            feed_id=feed_id,
+            uniq_id=hashlib.md5("http://example.com/history/{0}".format(n)).hexdigest(),
+            recv_dts=now,
+            publish_dts=now,
+            status=db.SENT,
+        ) for n in range(i, min(i + batch, rows))])
+
+
+def main(args):
+    ap = ArgumentParser(description="Benchmark feed polling against a large atom history")
+    ap.add_argument("-rows", help="Number of Atom rows to seed.", type=int, default=1000000)
+    ap.add_argument("-items", help="Number of items in the polled feed.", type=int, default=50)
+    ap.add_argument("-polls", help="Number of polls to time.", type=int, default=20)
+    ap.add_argument("-new", help="New items in each timed poll. 0 times polls that only dedup.", type=int, default=0)
+    _args = ap.parse_args(args)
+
+    workdir = mkdtemp()
+    dbschema = "sqlite:///" + join(workdir, "bench.db")
+    db.install(dbschema)
+
+    session = db.Session(dbschema)
+    feed = db.RssFeed(name="bench", hashtags="#bench", url="http://example.com/feed.xml", order=500, enable=True)
+    session.add(feed)
+    session.commit()
+
+    print("Seeding {0} atoms...".format(_args.rows))
+    start = time()
+    seed(dbschema, feed.id, _args.rows)
+    print("Seeded in {0:.1f}s".format(time() - start))
+
+    ## The first poll records the fixture items. With -new, each later poll
+    ## slides the window so its newest items have not been seen before
+    timings = []
+    for n in range(_args.polls):
+        body = fixtures.rss("bench", _args.items, start=n * _args.new)
+        start = time()
+        found = len(list(feed.get_new_atoms(db.SKIPPED, body=body)))
+        session.commit()
+        timings.append(time() - start)
+        if n == 0: print("First poll recorded {0} atoms".format(found))
+        elif found != _args.new: print("Poll {0} recorded {1} atoms, expected {2}".format(n, found, _args.new))
+        session.expire_all()
+
+    timings = sorted(timings[1:])
+    print("Poll time: min {0:.2f}ms, median {1:.2f}ms, max {2:.2f}ms".format(
+        timings[0] * 1000, timings[len(timings) // 2] * 1000, timings[-1] * 1000))
+    session.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,154 @@
+""" Local stand-ins for the services the bot talks to """
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Thread, Lock
+from urlparse import urlparse, parse_qs
+from time import sleep, time
+from gzip import GzipFile
+from StringIO import StringIO
+import hashlib
+import socket
+import random
+import json
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeService(object):
+    """ Base for a fake HTTP service on a free local port.
+
+    Every request waits `latency` seconds and fails with a 500 at
+    `error_rate`. Subclasses implement respond(handler) and return
+    (status, content_type, body) or (status, content_type, body, headers).
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.connections = 0
+        self._lock = Lock()
+        self._server = None
+
+    def respond(self, handler):
+        raise NotImplementedError
+
+    def _handler(self):
+        service = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                ## Keep-alive clients would otherwise stall on delayed ACKs
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with service._lock:
+                    service.connections += 1
+
+            def _serve(self):
+                with service._lock:
+                    service.requests += 1
+                if service.latency: sleep(service.latency)
+                if random.random() < service.error_rate:
+                    status, ctype, body, headers = 500, "text/plain", "fake error", {}
+                else:
+                    response = service.respond(self)
+                    status, ctype, body = response[:3]
+                    headers = response[3] if len(response) > 3 else {}
+                self.send_response(status)
+                self.send_header("Content-Type", ctype)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = _serve
+            do_POST = _serve
+
+            def log_message(self, *args):
+                pass
+
+        return _Handler
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return "http://{0}:{1}".format(host, port)
+
+    def start(self):
+        self._server = _Server(("127.0.0.1", 0), self._handler())
+        thread = Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class FakeShortener(FakeService):
+    """ Answers the bit.ly v3 shorten call with a stable fake short link """
+
+    def respond(self, handler):
+        query = parse_qs(urlparse(handler.path).query)
+        link = query.get('longUrl', [''])[0]
+        short = "http://fake.ly/{0}".format(hashlib.md5(link).hexdigest()[:7])
+        return 200, "application/json", json.dumps({
+            'status_code': 200,
+            'status_txt': "OK",
+            'data': {'url': short, 'long_url': link},
+        })
+
+
+class FakeFeedHost(FakeService):
+    """ Serves RSS documents at /<name>, gzipped when the client asks """
+
+    def __init__(self, feeds, latency=0.0, error_rate=0.0):
+        FakeService.__init__(self, latency, error_rate)
+        self.feeds = feeds
+        self._gzipped = {}
+
+    def feed_url(self, name):
+        return "{0}/{1}".format(self.url, name)
+
+    def respond(self, handler):
+        body = self.feeds.get(urlparse(handler.path).path.lstrip("/"))
+        if body is None:
+            return 404, "text/plain", "no such feed"
+        if "gzip" not in handler.headers.get("Accept-Encoding", ""):
+            return 200, "application/rss+xml", body
+        if body not in self._gzipped:
+            out = StringIO()
+            with GzipFile(fileobj=out, mode="wb") as fid:
+                fid.write(body)
+            self._gzipped[body] = out.getvalue()
+        return 200, "application/rss+xml", self._gzipped[body], {"Content-Encoding": "gzip"}
+
+
+class FakeTwitter(FakeService):
+    """ Accepts statuses/update calls and keeps every (time, status) posted.
+
+    Point [TWITTER_KEYS] at it with domain = host:port and secure = False.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        FakeService.__init__(self, latency, error_rate)
+        self.posts = []
+
+    @property
+    def domain(self):
+        return "{0}:{1}".format(*self._server.server_address)
+
+    def respond(self, handler):
+        body = handler.rfile.read(int(handler.headers.get("Content-Length", 0)))
+        if not urlparse(handler.path).path.endswith("/statuses/update.json"):
+            return 404, "application/json", json.dumps({'errors': [{'message': "no such call"}]})
+        status = parse_qs(body).get('status', [''])[0]
+        with self._lock:
+            self.posts.append((time(), status))
+            post_id = len(self.posts)
+        return 200, "application/json", json.dumps({'id': post_id, 'text': status})
@@ -0,0 +1,63 @@
+#!/usr/bin/env python2
+""" Compare fetching feeds that share a host with urllib2 and the pooled client """
+from argparse import ArgumentParser
+from os.path import dirname, abspath
+from time import time
+import urllib2
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from core import httpclient
+import fixtures
+import fakes
+
+
+def _urllib2(urls):
+    size = 0
+    for url in urls:
+        response = urllib2.urlopen(url)
+        try:
+            size += len(response.read())
+        finally:
+            response.close()
+    return size
+
+
+def _pooled(urls):
+    client = httpclient.HttpClient()
+    size = 0
+    try:
+        for url in urls:
+            size += client.get(url).bytes
+    finally:
+        client.close()
+    return size
+
+
+def main(args):
+    ap = ArgumentParser(description="Benchmark feed fetching over keep-alive connections")
+    ap.add_argument("-feeds", help="Number of feeds on the fake host.", type=int, default=5)
+    ap.add_argument("-items", help="Number of entries in each feed.", type=int, default=200)
+    ap.add_argument("-cycles", help="Number of poll cycles.", type=int, default=20)
+    _args = ap.parse_args(args)
+
+    host = fakes.FakeFeedHost(dict(("feed{0}".format(n), fixtures.rss("feed{0}".format(n), _args.items))
+                                   for n in range(_args.feeds)))
+    host.start()
+    urls = [host.feed_url("feed{0}".format(n)) for n in range(_args.feeds)] * _args.cycles
+
+    try:
+        for name, fn in [("urllib2", _urllib2), ("pooled", _pooled)]:
+            host.connections = 0
+            start = time()
+            size = fn(urls)
+            elapsed = time() - start
+            print("{0:8}: {1:8.1f}ms, {2:5} connections, {3:.1f} MB on the wire".format(
+                name, elapsed * 1000, host.connections, size / 1048576.0))
+    finally:
+        host.stop()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,33 @@
+""" Helpers to build fixture feeds for the benchmarks """
+from email.utils import formatdate
+from xml.sax.saxutils import escape
+from time import time
+
+
+def rss(title, items, base="http://example.com/item", start=0, published=None, guids=0):
+    """ Build an RSS 2.0 document with `items` entries, newest first
+
+    With guids, every guids-th entry gives its link only as a permalink <guid>.
+    """
+    if published is None: published = int(time())
+
+    entries = []
+    for i in range(start + items - 1, start - 1, -1):
+        link = "<guid>{0}/{1}</guid>" if guids and i % guids == 0 else "<link>{0}/{1}</link>"
+        entries.append(
+            "<item><title>{0}</title>{1}"
+            "<description>Item {2} of {3}</description>"
+            "<category>bench</category><pubDate>{4}</pubDate></item>".format(
+                escape("{0} story number {1}".format(title, i)), link.format(base, i), i, title,
+                formatdate(published - (start + items - i) * 60)))
+
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<rss version="2.0"><channel><title>{0}</title><link>{1}</link>'
+        '<description>{0}</description>{2}</channel></rss>'.format(escape(title), base, "".join(entries)))
+
+
+def write_rss(path, title, items, **kwargs):
+    with open(path, "w") as fid:
+        fid.write(rss(title, items, **kwargs))
+    return path
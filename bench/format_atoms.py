@@ -0,0 +1,55 @@
+#!/usr/bin/env python2
+""" Measure how fast atoms are formatted into tweets """
+from argparse import ArgumentParser
+from os.path import dirname, abspath, join
+from time import time
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from core import formatter
+
+TAGS = ["#technology", "#privacy", "#electronics", "#arduino", "#networksecurity", "#arm", "#fail"]
+
+
+class _Section(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def load_items(path, repeat):
+    with open(path) as fid:
+        titles = [line.strip() for line in fid if line.strip()]
+
+    items = []
+    for n in range(repeat):
+        for m, title in enumerate(titles):
+            items.append({
+                'title': title,
+                'short_link': "http://bit.ly/{0:07x}".format(n * len(titles) + m),
+                'tags': set(TAGS[:(m % len(TAGS))]),
+            })
+    return items
+
+
+def main(args):
+    ap = ArgumentParser(description="Benchmark the tweet formatter")
+    ap.add_argument("-titles", help="File with one title per line.", type=str,
+                    default=join(dirname(abspath(__file__)), "titles.txt"))
+    ap.add_argument("-repeat", help="Times to repeat the corpus.", type=int, default=2500)
+    ap.add_argument("-link_weight", help="Fixed link length, 0 for the real length.", type=int, default=0)
+    _args = ap.parse_args(args)
+
+    config = _Section(format=_Section(tweet_length=140, link_weight=_args.link_weight, title_split=80))
+    items = load_items(_args.titles, _args.repeat)
+
+    start = time()
+    tweets = formatter.format_many(items, config)
+    elapsed = time() - start
+
+    print("Formatted {0} atoms in {1:.3f}s ({2:.2f}us per atom)".format(len(tweets), elapsed, elapsed / len(tweets) * 1e6))
+    print("Longest tweet: {0} characters".format(max(len(t) for t in tweets)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
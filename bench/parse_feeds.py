@@ -0,0 +1,76 @@
+#!/usr/bin/env python2
+""" Compare parse time and peak memory of feedparser and the streaming reader """
+from argparse import ArgumentParser
+from os.path import dirname, abspath
+from time import time
+import resource
+import sys
+import os
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from core import feedstream
+import feedparser
+import fixtures
+
+
+def _feedparser(body, stop):
+    return len(feedparser.parse(body)['items'])
+
+
+def _stream(body, stop):
+    count = 0
+    for entry in feedstream.entries(body):
+        count += 1
+        if stop and count >= stop: break
+    return count
+
+
+def measure(fn, body, stop):
+    """ Run fn in a child process and report (seconds, entries, peak KB above baseline) """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time()
+        count = fn(body, stop)
+        elapsed = time() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+        os.write(w, "{0} {1} {2}".format(elapsed, count, peak))
+        os._exit(0)
+
+    os.close(w)
+    result = os.read(r, 1024).split()
+    os.waitpid(pid, 0)
+    return float(result[0]), int(result[1]), int(result[2])
+
+
+def main(args):
+    ap = ArgumentParser(description="Benchmark feed parsing")
+    ap.add_argument("-items", help="Number of entries in the fixture feed.", type=int, default=2000)
+    ap.add_argument("-body", help="Bytes of description per entry.", type=int, default=2000)
+    ap.add_argument("-stop", help="Entries read before the streaming reader meets a known one.", type=int, default=2)
+    ap.add_argument("-guids", help="Every Nth entry gives its link only as a permalink guid. 0 for none.", type=int, default=10)
+    _args = ap.parse_args(args)
+
+    ## Pad the descriptions to look like a podcast feed's show notes
+    body = fixtures.rss("bench", _args.items, guids=_args.guids).replace("</description>", ("x" * _args.body) + "</description>")
+    print("Fixture feed: {0} entries, {1:.1f} MB".format(_args.items, len(body) / 1048576.0))
+
+    ## Both readers must find the same links, including the guid only ones
+    expected = [entry.get('link') for entry in feedparser.parse(body)['items']]
+    found = [entry.get('link') for entry in feedstream.entries(body)]
+    if found != expected:
+        print("MISMATCH: the streaming reader found {0} of {1} links".format(
+            len(set(found) & set(expected)), len(expected)))
+
+    for name, fn, stop in [("feedparser", _feedparser, 0),
+                           ("stream", _stream, 0),
+                           ("stream (stop at {0})".format(_args.stop), _stream, _args.stop)]:
+        elapsed, count, peak = measure(fn, body, stop)
+        print("{0:20}: {1:8.1f}ms, {2:5} entries, peak +{3} KB".format(name, elapsed * 1000, count, peak))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,216 @@
+#!/usr/bin/env python2
+""" Run the whole pipeline against fake feed, shortener and Twitter servers.
+
+N feeds of M items are served by a FakeFeedHost, and create_thread_plan is
+run unchanged from a real config file. The run has two phases:
+
+    ingest - until every atom is waiting for its slot or was dropped
+    send   - tweets go out one per second, the fastest the Scheduler plans
+             slots, for -seconds or until every atom is sent
+
+Exact latencies come from a tracker that records every atom's age, and the
+per-stage histograms from core.metrics.
+"""
+from argparse import ArgumentParser
+from os.path import dirname, abspath, join
+from tempfile import mkdtemp
+from time import time, sleep, strftime, localtime
+import resource
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from core import db, httpclient, metrics, Config
+from core.stopwatch import LapStats, now
+import twitterbot
+import fixtures
+import fakes
+
+_RC = """[SCHEDULE]
+dynamic_enabled = False
+window_start = {window_start}
+window_duration = {total}
+batch_enabled = {batch}
+[TWEET_QUOTA]
+count = {total}
+delta = 0
+joke_align = 1000000
+expire_delta = 86400
+[TWITTER_KEYS]
+app = bench
+cred_path = {tmp}/creds
+key = bench
+secret = bench
+domain = {twitter}
+secure = False
+[BITLY_KEYS]
+user = bench
+key = bench
+endpoint = {shortener}
+workers = {shorten_workers}
+rate_limit = 600000
+rate_burst = 1000
+retries = 1
+[CALAIS_KEYS]
+key = bench
+[RESOURCES]
+dbschema = {dbschema}
+pidfile = {tmp}/pid
+[THREADS]
+queue_size = {total}
+atom_query_delta = 0
+fetch_concurrency = 8
+poll_min_delta = 3600
+poll_max_delta = 3600
+flush_delta = 1
+queue_path = {queue_path}
+[METRICS]
+log_delta = 0
+"""
+
+
+class _Tracker(metrics.AtomTracker):
+    """ Keeps the exact age of every atom as it reaches WAIT, SENT or DROPPED """
+
+    def __init__(self, registry):
+        metrics.AtomTracker.__init__(self, registry)
+        self.laps = dict((status, LapStats(100000)) for status in (db.WAIT, db.SENT, db.DROPPED))
+
+    def transition(self, ident, status, when=None):
+        age = metrics.AtomTracker.transition(self, ident, status, when)
+        if age is not None and status in self.laps:
+            self.laps[status].record(int(age * 1e9))
+        return age
+
+
+def _install(tmp, host, feeds):
+    dbschema = "sqlite:///{0}".format(join(tmp, "bench.db"))
+    db.install(dbschema)
+    session = db.Session(dbschema)
+    for n in range(feeds):
+        session.add(db.RssFeed(name="feed{0}".format(n), url=host.feed_url("feed{0}".format(n)), hashtags="bench",
+                               order=n, enable=True))
+    session.commit()
+    session.close()
+    return dbschema
+
+
+def _wait(done, seconds):
+    deadline = now() + seconds
+    while not done() and now() < deadline:
+        sleep(0.05)
+    return done()
+
+
+def _dropped(before_wait):
+    """ Atoms dropped by the stages before WAIT, or by the tweet stage """
+    return sum(metric.value for (name, labels), metric in metrics.registry.items()
+               if name == "atoms_dropped_total" and (dict(labels)['reason'] != "post_failed") == before_wait)
+
+
+def _laps(name, stats):
+    s = stats.summary()
+    print("{0:16}: {1:6} atoms, p50 {2:8.3f}s, p90 {3:8.3f}s, p99 {4:8.3f}s, max {5:8.3f}s".format(
+        name, s['count'], s['p50'], s['p90'], s['p99'], s['max']))
+
+
+def _histogram(name):
+    h = metrics.registry.histogram(name)
+    if not h.count: return
+    print("{0:16}: {1:6} calls, mean {2:8.4f}s, p50 <= {3}s, p99 <= {4}s".format(
+        name, h.count, h.sum / h.count, h.percentile(0.5), h.percentile(0.99)))
+
+
+def main(args):
+    ap = ArgumentParser(description="Benchmark the pipeline end to end against local fake services")
+    ap.add_argument("-feeds", help="Number of feeds.", type=int, default=20)
+    ap.add_argument("-items", help="Number of items in each feed.", type=int, default=20)
+    ap.add_argument("-feed-latency", help="Seconds the feed host takes to answer.", type=float, default=0.05)
+    ap.add_argument("-feed-errors", help="Fraction of feed requests that fail.", type=float, default=0.0)
+    ap.add_argument("-shortener-latency", help="Seconds the shortener takes to answer.", type=float, default=0.05)
+    ap.add_argument("-shortener-errors", help="Fraction of shortener calls that fail.", type=float, default=0.0)
+    ap.add_argument("-shorten-workers", help="Shortener pool threads.", type=int, default=4)
+    ap.add_argument("-twitter-latency", help="Seconds the status update takes.", type=float, default=0.1)
+    ap.add_argument("-twitter-errors", help="Fraction of status updates that fail.", type=float, default=0.0)
+    ap.add_argument("-seconds", help="Longest time to spend in each phase.", type=int, default=30)
+    ap.add_argument("-batch", help="Use the batch scheduler.", action="store_true")
+    ap.add_argument("-durable", help="Keep the stage queues in SQLite.", action="store_true")
+    _args = ap.parse_args(args)
+
+    total = _args.feeds * _args.items
+    tmp = mkdtemp()
+    with open(join(tmp, "creds"), "w") as fid: fid.write("bench\nbench\n")
+
+    host = fakes.FakeFeedHost(dict(("feed{0}".format(n), fixtures.rss("feed{0}".format(n), _args.items, base="http://example.com/{0}".format(n)))
+                                   for n in range(_args.feeds)), _args.feed_latency, _args.feed_errors)
+    shortener = fakes.FakeShortener(_args.shortener_latency, _args.shortener_errors)
+    twitter = fakes.FakeTwitter(_args.twitter_latency, _args.twitter_errors)
+    for service in (host, shortener, twitter): service.start()
+
+    rc = join(tmp, "bench.rc")
+    with open(rc, "w") as fid:
+        fid.write(_RC.format(window_start=strftime("%H:%M:%S", localtime(time() + 2)), total=total,
+                             batch=_args.batch, tmp=tmp, twitter=twitter.domain, shortener=shortener.url,
+                             shorten_workers=_args.shorten_workers, dbschema=_install(tmp, host, _args.feeds),
+                             queue_path=join(tmp, "queues.db") if _args.durable else ""))
+    config = Config(rc)
+
+    tracker = metrics.atoms = _Tracker(metrics.registry)
+    waiting = lambda: tracker.laps[db.WAIT].count
+
+    def _ingested():
+        fetched = metrics.registry.histogram("fetch_seconds").count + metrics.registry.counter("fetch_errors_total").value
+        received = metrics.registry.counter("atoms_received_total").value
+        return fetched >= _args.feeds and waiting() + _dropped(True) >= received
+
+    def _sent():
+        return tracker.laps[db.SENT].count + _dropped(False) >= waiting()
+
+    ## Keep the stages' chatter out of the report
+    stdout, sys.stdout = sys.stdout, open("/dev/null", "w")
+    try:
+        tp, pflag, transitions = twitterbot.create_thread_plan(config)
+        transitions.start()
+        th = twitterbot.start_threads(tp)
+
+        start = now()
+        pflag.set()
+        _wait(_ingested, _args.seconds)
+        ingest = now() - start
+
+        sent = now()
+        _wait(_sent, _args.seconds)
+        sending = now() - sent
+    finally:
+        sys.stdout = stdout
+
+    print("{0} feeds x {1} items, {2} scheduler, {3} queues".format(
+        _args.feeds, _args.items, "batch" if _args.batch else "greedy", "durable" if _args.durable else "memory"))
+    print("{0:16}: {1:6} atoms in {2:.2f}s, {3:.1f} atoms/s".format(
+        "ingest", tracker.laps[db.WAIT].count, ingest, tracker.laps[db.WAIT].count / ingest))
+    print("{0:16}: {1:6} posts in {2:.2f}s, {3:.2f} posts/s".format(
+        "send", len(twitter.posts), sending, len(twitter.posts) / sending))
+    _laps("receipt to WAIT", tracker.laps[db.WAIT])
+    _laps("receipt to SENT", tracker.laps[db.SENT])
+    _laps("receipt to DROP", tracker.laps[db.DROPPED])
+    for name in ("fetch_seconds", "parse_seconds", "shorten_seconds", "format_seconds", "post_seconds"):
+        _histogram(name)
+    drops = [(dict(labels).get('reason'), metric.value) for (name, labels), metric in metrics.registry.items()
+             if name == "atoms_dropped_total" and metric.value]
+    print("{0:16}: {1}".format("drops", ", ".join("{0} {1}".format(*d) for d in drops) or "none"))
+    print("{0:16}: {1:.1f} MB".format("peak RSS", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+    print("Stopping the pipeline...")
+    stdout, sys.stdout = sys.stdout, open("/dev/null", "w")
+    try:
+        pflag.clear()
+        twitterbot.wait_threads(th)
+        transitions.stop()
+        httpclient.get_client().close()
+    finally:
+        sys.stdout = stdout
+        for service in (host, shortener, twitter): service.stop()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
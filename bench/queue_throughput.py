@@ -0,0 +1,61 @@
+#!/usr/bin/env python2
+""" Compare the in-memory and durable stage queues """
+from argparse import ArgumentParser
+from os.path import dirname, abspath, join
+from operator import itemgetter
+from tempfile import mkdtemp
+from threading import Thread
+from time import time
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from core import queues
+
+
+def run(queues, items):
+    """ Pass items through the chain of queues and ack each at the end, as the tweet stage does """
+    payload = {'title': "x" * 80, 'link': "http://example.com/", 'tags': set(["#bench"]), 'recv': 0}
+
+    def _produce():
+        for n in range(items):
+            item = dict(payload, ident=str(n))
+            queues[0].put(item)
+
+    def _move(in_queue, out_queue):
+        for n in range(items):
+            out_queue.put(in_queue.get())
+
+    def _consume():
+        for n in range(items):
+            item = queues[-1].get()
+            queues[-1].ack(item['ident'])
+
+    start = time()
+    threads = [Thread(target=_produce), Thread(target=_consume)]
+    threads.extend(Thread(target=_move, args=pair) for pair in zip(queues, queues[1:]))
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return time() - start
+
+
+def main(args):
+    ap = ArgumentParser(description="Benchmark the pipeline queues")
+    ap.add_argument("-items", help="Number of atoms to pass through the queue.", type=int, default=20000)
+    ap.add_argument("-size", help="Queue maxsize.", type=int, default=100)
+    ap.add_argument("-hops", help="Queues each atom passes through. The pipeline has 3.", type=int, default=3)
+    _args = ap.parse_args(args)
+
+    memory = run([queues.MemoryQueue(maxsize=_args.size) for n in range(_args.hops)], _args.items)
+    store = queues.QueueStore(join(mkdtemp(), "queue.db"))
+    durable = run([queues.DurableQueue(store, "bench{0}".format(n), itemgetter('ident'), maxsize=_args.size)
+                   for n in range(_args.hops)], _args.items)
+    store.close()
+
+    print("Memory  : {0:.2f}s ({1:.0f} atoms/s)".format(memory, _args.items / memory))
+    print("Durable : {0:.2f}s ({1:.0f} atoms/s)".format(durable, _args.items / durable))
+    print("Factor  : {0:.1f}x".format(durable / memory))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
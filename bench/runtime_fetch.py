@@ -0,0 +1,65 @@
+#!/usr/bin/env python2
+""" Fetch hundreds of slow feeds under the threads or gevent runtime """
+from argparse import ArgumentParser
+from os.path import dirname, abspath
+from threading import Thread
+from time import time, sleep
+import resource
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from core import Crawler, httpclient, runtime
+import fixtures
+import fakes
+
+
+def _cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def main(args):
+    ap = ArgumentParser(description="Benchmark concurrent feed fetching per runtime")
+    ap.add_argument("-runtime", help="How to run the fetch pool.", choices=runtime.RUNTIMES, default=runtime.THREADS)
+    ap.add_argument("-hosts", help="Number of fake feed hosts.", type=int, default=100)
+    ap.add_argument("-feeds", help="Feeds per host.", type=int, default=3)
+    ap.add_argument("-latency", help="Seconds each host takes to answer.", type=float, default=1.0)
+    ap.add_argument("-idle", help="Seconds to sit idle after the fetch.", type=int, default=5)
+    _args = ap.parse_args(args)
+
+    runtime.ensure(_args.runtime, sys.argv)
+
+    body = fixtures.rss("bench", 20)
+    hosts = [fakes.FakeFeedHost(dict(("feed{0}".format(n), body) for n in range(_args.feeds)), latency=_args.latency)
+             for h in range(_args.hosts)]
+    jobs = []
+    for host in hosts:
+        host.start()
+        jobs.extend((len(jobs), host.feed_url("feed{0}".format(n)), None) for n in range(_args.feeds))
+
+    crawler = Crawler(concurrency=len(jobs), per_host=_args.feeds, client=httpclient.HttpClient(max_per_host=_args.feeds))
+
+    cpu, start = _cpu(), time()
+    results = crawler.fetch(jobs)
+    elapsed, used = time() - start, _cpu() - cpu
+
+    ## Each shutdown waits out the server's poll interval, so stop them together
+    stoppers = [Thread(target=host.stop) for host in hosts]
+    for stopper in stoppers: stopper.start()
+    for stopper in stoppers: stopper.join()
+
+    ## Pooled keep-alive connections stay open while idle
+    cpu = _cpu()
+    sleep(_args.idle)
+    idle = _cpu() - cpu
+
+    print("Runtime : {0}".format(runtime.active()))
+    print("Fetched : {0}/{1} feeds in {2:.2f}s using {3:.2f}s CPU".format(
+        sum(1 for r in results if r.status), len(jobs), elapsed, used))
+    print("Idle    : {0:.3f}s CPU over {1}s".format(idle, _args.idle))
+    print("Peak RSS: {0:.1f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,56 @@
+#!/usr/bin/env python2
+""" Measure how long the Scheduler takes to plan tweet slots """
+from argparse import ArgumentParser
+from os.path import dirname, abspath
+from time import time, strptime
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from core import Scheduler
+
+
+class _Section(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def make_config(windows, duration, count):
+    starts = [strptime("{0:02d}:{1:02d}:00".format((n * 24 * 60 // windows) // 60, (n * 24 * 60 // windows) % 60), "%H:%M:%S")
+              for n in range(windows)]
+    return _Section(
+        schedule=_Section(dynamic_enabled=False, window_start=starts, window_duration=duration),
+        tweet_quota=_Section(count=count),
+    )
+
+
+def main(args):
+    ap = ArgumentParser(description="Benchmark Scheduler.plan")
+    ap.add_argument("-windows", help="Number of windows per day.", type=int, default=48)
+    ap.add_argument("-duration", help="Window duration in seconds.", type=int, default=1200)
+    ap.add_argument("-count", help="Tweets per window.", type=int, default=30)
+    ap.add_argument("-slots", help="Number of slots to plan.", type=int, default=10000)
+    ap.add_argument("-runs", help="Number of timed runs.", type=int, default=20)
+    _args = ap.parse_args(args)
+
+    scheduler = Scheduler(make_config(_args.windows, _args.duration, _args.count))
+    seed = int(time())
+
+    timings = []
+    for n in range(_args.runs):
+        start = time()
+        slots, end = scheduler.plan(seed, _args.slots)
+        timings.append(time() - start)
+
+    timings.sort()
+    print("Planned {0} slots over {1:.1f} days".format(len(slots), (end - seed) / 86400.0))
+    print("Plan time: min {0:.2f}ms, median {1:.2f}ms".format(timings[0] * 1000, timings[len(timings) // 2] * 1000))
+
+    ## One week ahead, as the schedule thread would ask for it window by window
+    start = time()
+    week, end = scheduler.plan(seed, _args.windows * _args.count * 7)
+    print("Planned one week ({0} slots) in {1:.2f}ms".format(len(week), (time() - start) * 1000))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
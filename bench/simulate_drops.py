@@ -0,0 +1,109 @@
+#!/usr/bin/env python2
+""" Replay atom recv times through the schedulers and count dropped atoms """
+from argparse import ArgumentParser
+from collections import deque
+from itertools import groupby
+from os.path import dirname, abspath
+from time import time
+import random
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from core import Scheduler
+from scheduler_plan import make_config
+
+
+def simulate_greedy(scheduler, count, recvs, expire_delta):
+    """ One atom per slot, in arrival order, as the schedule thread does by default """
+    sent, dropped, delays = 0, 0, []
+    n, seed = 0, recvs[0]
+    while n < len(recvs):
+        slots, seed = scheduler.plan(seed, count)
+        for slot in slots:
+            while n < len(recvs) and recvs[n] < slot:
+                if slot - recvs[n] > expire_delta:
+                    dropped += 1
+                    n += 1
+                    continue
+                sent += 1
+                delays.append(slot - recvs[n])
+                n += 1
+                break
+    return sent, dropped, delays
+
+
+def simulate_batch(scheduler, count, recvs, expire_delta):
+    """ Earliest-deadline-first over every waiting atom, replanned on each arrival """
+    sent, dropped, delays = 0, 0, []
+    slots, waiting, seed = deque(), [], recvs[0]
+    for now, group in groupby(recvs):
+        waiting.extend({'recv': recv} for recv in group)
+        while len(slots) < len(waiting):
+            more, seed = scheduler.plan(seed, len(waiting) - len(slots))
+            slots.extend(more)
+        assigned, expired, waiting = Scheduler.assign(waiting, slots, now, expire_delta)
+        sent += len(assigned)
+        dropped += len(expired)
+        delays.extend(slot - atom['recv'] for slot, atom in assigned)
+
+    ## Whatever is still waiting once the arrivals stop
+    while waiting:
+        if len(slots) == 0:
+            slots, seed = scheduler.plan(seed, len(waiting))
+        assigned, expired, waiting = Scheduler.assign(waiting, slots, 0, expire_delta)
+        sent += len(assigned)
+        dropped += len(expired)
+        delays.extend(slot - atom['recv'] for slot, atom in assigned)
+    return sent, dropped, delays
+
+
+def bursty(days, polls_per_day, mean_burst, start):
+    """ Feeds are polled at fixed times and return a random sized burst each poll """
+    recvs = []
+    for n in range(days * polls_per_day):
+        t = start + n * (86400 // polls_per_day)
+        recvs.extend([t] * int(random.expovariate(1.0 / mean_burst)))
+    return recvs
+
+
+def report(name, result):
+    sent, dropped, delays = result
+    total = max(sent + dropped, 1)
+    delays.sort()
+    median = delays[len(delays) // 2] if delays else 0
+    print("{0:7}: sent {1}, dropped {2} ({3:.1%}), median wait {4}s".format(name, sent, dropped, float(dropped) / total, median))
+
+
+def main(args):
+    ap = ArgumentParser(description="Compare drop rates of the greedy and batch schedulers")
+    ap.add_argument("-recv", help="File of recorded recv timestamps, one per line.", type=str)
+    ap.add_argument("-windows", help="Number of windows per day.", type=int, default=4)
+    ap.add_argument("-duration", help="Window duration in seconds.", type=int, default=3600)
+    ap.add_argument("-count", help="Tweets per window.", type=int, default=6)
+    ap.add_argument("-expire", help="expire_delta in seconds.", type=int, default=6 * 3600)
+    ap.add_argument("-days", help="Days of synthetic arrivals.", type=int, default=7)
+    ap.add_argument("-polls", help="Synthetic polls per day.", type=int, default=24)
+    ap.add_argument("-burst", help="Mean synthetic burst size.", type=float, default=2.0)
+    ap.add_argument("-seed", help="Random seed for synthetic arrivals.", type=int, default=1)
+    _args = ap.parse_args(args)
+
+    if _args.recv:
+        with open(_args.recv) as fid:
+            recvs = sorted(int(line) for line in fid if line.strip())
+    else:
+        random.seed(_args.seed)
+        recvs = bursty(_args.days, _args.polls, _args.burst, int(time()))
+
+    if not recvs:
+        print("No arrivals to replay")
+        return
+
+    scheduler = Scheduler(make_config(_args.windows, _args.duration, _args.count))
+    print("Replaying {0} atoms".format(len(recvs)))
+    report("greedy", simulate_greedy(scheduler, _args.count, recvs, _args.expire))
+    report("batch", simulate_batch(scheduler, _args.count, recvs, _args.expire))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
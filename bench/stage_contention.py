@@ -0,0 +1,129 @@
+#!/usr/bin/env python2
+""" Measure database latency seen by the other stages while the feed stage crawls a slow server """
+from argparse import ArgumentParser
+from os.path import dirname, abspath, join
+from threading import Thread, Event, Lock
+from tempfile import mkdtemp
+from time import time, sleep
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from core import db, Crawler, TransitionBuffer, queues
+from scheduler_plan import _Section
+import twitterbot
+import fixtures
+import fakes
+
+
+def _percentile(samples, pct):
+    if not samples: return 0.0
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * pct), len(samples) - 1)]
+
+
+def _serialized_feed(config, stop, lock):
+    """ The feed stage as it was: one lock shared by every stage, held across the crawl """
+    crawler = Crawler(config.threads.fetch_concurrency, config.threads.fetch_per_host)
+    while not stop.isSet():
+        with lock:
+            session = db.Session(config.resources.dbschema)
+            jobs = [(f.id, f.url, None) for f in session.query(db.RssFeed)]
+            crawler.fetch(jobs)
+            session.commit()
+            session.close()
+
+
+def _probe(name, fn, stop, lock, samples):
+    """ Time fn every 50ms the way a stage would run its database step """
+    while not stop.isSet():
+        start = time()
+        if lock:
+            with lock: fn()
+        else:
+            fn()
+        samples.append(time() - start)
+        sleep(0.05)
+
+
+def main(args):
+    ap = ArgumentParser(description="Benchmark stage latency while feeds are fetched")
+    ap.add_argument("-feeds", help="Number of feeds on the fake host.", type=int, default=4)
+    ap.add_argument("-latency", help="Seconds the fake host takes to answer.", type=float, default=2.0)
+    ap.add_argument("-seconds", help="How long to run.", type=int, default=10)
+    ap.add_argument("-serialized", help="Model the old shared session lock.", action="store_true")
+    _args = ap.parse_args(args)
+
+    dbschema = "sqlite:///{0}".format(join(mkdtemp(), "bench.db"))
+    db.install(dbschema)
+
+    host = fakes.FakeFeedHost(dict(("feed{0}".format(n), fixtures.rss("feed{0}".format(n), 20, base="http://example.com/{0}".format(n)))
+                                   for n in range(_args.feeds)), latency=_args.latency)
+    host.start()
+
+    session = db.Session(dbschema)
+    for n in range(_args.feeds):
+        session.add(db.RssFeed(name="feed{0}".format(n), url=host.feed_url("feed{0}".format(n)),
+                                 hashtags="", order=n, enable=True))
+    for n in range(1000):
+        session.add(db.Joke(body="joke {0}".format(n), sent=False))
+    session.commit()
+    session.close()
+
+    config = _Section(
+        resources=_Section(dbschema=dbschema),
+        threads=_Section(fetch_concurrency=2, fetch_per_host=2, poll_min_delta=0, poll_max_delta=1,
+                         atom_query_delta=0, early_stop=False),
+    )
+
+    lock = Lock() if _args.serialized else None
+    transitions = TransitionBuffer(dbschema, max_size=1000, max_delay=3600)
+
+    def _flush():
+        transitions.push(db.DROPPED, "none")
+        transitions.flush()
+
+    def _joke():
+        session = db.Session(dbschema)
+        try:
+            db.Joke.get_next(session)
+            session.commit()
+        finally:
+            session.close()
+
+    stop = Event()
+    pflag = Event()
+    pflag.set()
+    if _args.serialized:
+        feeder = Thread(target=_serialized_feed, args=(config, stop, lock))
+    else:
+        feeder = Thread(target=twitterbot.feed, args=(config, queues.MemoryQueue(), pflag, Event()))
+
+    stages = [("transitions", _flush), ("joke", _joke)]
+    samples = dict((name, []) for name, fn in stages)
+    probes = [Thread(target=_probe, args=(name, fn, stop, lock, samples[name])) for name, fn in stages]
+
+    ## Keep the feed thread's chatter out of the report
+    stdout, sys.stdout = sys.stdout, open("/dev/null", "w")
+    try:
+        feeder.start()
+        for probe in probes: probe.start()
+        sleep(_args.seconds)
+    finally:
+        stop.set()
+        pflag.clear()
+        for probe in probes: probe.join()
+        feeder.join()
+        sys.stdout = stdout
+        host.stop()
+
+    print("Feed host answers in {0:.1f}s, {1} requests served".format(_args.latency, host.requests))
+    for name, fn in stages:
+        timings = samples[name]
+        print("{0:12}: {1:5} ops, p50 {2:8.1f}ms, p99 {3:8.1f}ms, max {4:8.1f}ms".format(
+            name, len(timings), _percentile(timings, 0.5) * 1000, _percentile(timings, 0.99) * 1000,
+            max(timings or [0]) * 1000))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,187 @@
+#!/usr/bin/env python2
+""" Replay days of atom arrivals through the real schedule and tweet stages on a SimulatedClock.
+
+The schedule and tweet stages from twitterbot.py run unchanged. Short links
+are skipped, and statuses go to a FakeTwitter. Time jumps to the next
+event whenever every stage is waiting, so the drop rate and how close each
+tweet lands to its slot come out in seconds instead of days.
+"""
+from argparse import ArgumentParser
+from collections import defaultdict
+from itertools import groupby
+from os.path import dirname, abspath, join
+from tempfile import mkdtemp
+from threading import Event, Lock
+from time import time, strftime
+import random
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from core import db, Config, Scheduler, SimulatedClock
+from simulate_drops import bursty, report, simulate_greedy, simulate_batch
+from scheduler_plan import make_config
+import twitterbot
+import fakes
+
+_RC = """[SCHEDULE]
+dynamic_enabled = False
+window_start = {windows}
+window_duration = {duration}
+batch_enabled = {batch}
+[TWEET_QUOTA]
+count = {count}
+delta = {delta}
+joke_align = 1000000
+expire_delta = {expire}
+[TWITTER_KEYS]
+app = bench
+cred_path = {tmp}/creds
+key = bench
+secret = bench
+domain = {twitter}
+secure = False
+[RESOURCES]
+dbschema = sqlite:///{tmp}/bench.db
+pidfile = {tmp}/pid
+[THREADS]
+queue_size = 0
+atom_query_delta = 0
+"""
+
+
+class _Recorder(object):
+    """ Stands in for the TransitionBuffer and notes when each atom changed status """
+
+    def __init__(self, clock):
+        self._clock = clock
+        self._lock = Lock()
+        self.at = defaultdict(dict)
+        self.counts = defaultdict(int)
+        self.recvs = {}
+        self.slots = {}
+
+    def push(self, status, uid, short_link=None):
+        with self._lock:
+            self.at[uid][status] = self._clock.time()
+            self.counts[status] += 1
+
+
+def _passthrough(config, in_queue, out_queue, pflag, cflag, transitions, link_cache=None, clock=None):
+    """ The format stage without a shortener: the status is the atom's ident """
+    pflag.wait()
+    cflag.set()
+    while pflag.isSet() or not in_queue.empty():
+        try:
+            i = in_queue.get(timeout=10)
+        except twitterbot.Empty:
+            continue
+        transitions.slots[i['ident']] = i['schedule']
+        transitions.push(db.FORMATTED, i['ident'])
+        out_queue.put((i['ident'], i['schedule'], i['ident']))
+    cflag.clear()
+
+
+def _percentile(samples, pct):
+    if not samples: return 0.0
+    return samples[min(int(len(samples) * pct), len(samples) - 1)]
+
+
+def main(args):
+    ap = ArgumentParser(description="Replay atom arrivals through the schedule and tweet stages in simulated time")
+    ap.add_argument("-recv", help="File of recorded recv timestamps, one per line.", type=str)
+    ap.add_argument("-windows", help="Number of windows per day.", type=int, default=4)
+    ap.add_argument("-duration", help="Window duration in seconds.", type=int, default=3600)
+    ap.add_argument("-count", help="Tweets per window.", type=int, default=6)
+    ap.add_argument("-delta", help="Seconds the tweet stage rests after each tweet.", type=int, default=60)
+    ap.add_argument("-expire", help="expire_delta in seconds.", type=int, default=6 * 3600)
+    ap.add_argument("-days", help="Days of synthetic arrivals.", type=int, default=7)
+    ap.add_argument("-polls", help="Synthetic polls per day.", type=int, default=24)
+    ap.add_argument("-burst", help="Mean synthetic burst size.", type=float, default=2.0)
+    ap.add_argument("-seed", help="Random seed for synthetic arrivals.", type=int, default=1)
+    ap.add_argument("-batch", help="Use the batch scheduler.", action="store_true")
+    _args = ap.parse_args(args)
+
+    if _args.recv:
+        with open(_args.recv) as fid:
+            recvs = sorted(int(line) for line in fid if line.strip())
+    else:
+        ## From a fixed midnight, so two runs with one seed replay the same arrivals
+        random.seed(_args.seed)
+        recvs = bursty(_args.days, _args.polls, _args.burst, 1500000000 - 1500000000 % 86400)
+
+    if not recvs:
+        print("No arrivals to replay")
+        return
+
+    tmp = mkdtemp()
+    with open(join(tmp, "creds"), "w") as fid: fid.write("bench\nbench\n")
+    twitter = fakes.FakeTwitter()
+    twitter.start()
+
+    windows = make_config(_args.windows, _args.duration, _args.count)
+    rc = join(tmp, "bench.rc")
+    with open(rc, "w") as fid:
+        fid.write(_RC.format(windows=" ".join(strftime("%H:%M:%S", w) for w in windows.schedule.window_start),
+                             duration=_args.duration, batch=_args.batch, count=_args.count, delta=_args.delta,
+                             expire=_args.expire, tmp=tmp, twitter=twitter.domain))
+    config = Config(rc)
+
+    clock = SimulatedClock(recvs[0])
+    transitions = _Recorder(clock)
+    schdFlag = Event()
+    plan, schdQueue = twitterbot._pipeline(config, None, schdFlag, transitions, clock=clock)
+    plan['fmtThread'] = (_passthrough, plan['fmtThread'][1])
+
+    ## Give up on atoms that are neither sent nor dropped a week after the last arrival
+    give_up = recvs[-1] + _args.expire + 7 * 86400
+    done = lambda: transitions.counts[db.SENT] + transitions.counts[db.DROPPED] >= len(recvs)
+
+    ## The stages log every atom. Keep that out of the report
+    stdout, sys.stdout = sys.stdout, open("/dev/null", "w")
+    start = time()
+    try:
+        clock.enter()
+        threads = twitterbot.start_threads(plan, clock)
+        schdFlag.set()
+
+        for n, (recv, group) in enumerate(groupby(recvs)):
+            clock.sleep(recv - clock.time())
+            for m, _ in enumerate(group):
+                ident = "atom{0}.{1}".format(n, m)
+                transitions.recvs[ident] = recv
+                schdQueue.put({'ident': ident, 'recv': recv, 'title': "", 'link': ""})
+
+        while not done() and clock.time() < give_up:
+            clock.sleep(3600)
+        span = clock.time() - recvs[0]
+
+        schdFlag.clear()
+        clock.leave()
+        twitterbot.wait_threads(threads)
+    finally:
+        sys.stdout = stdout
+        twitter.stop()
+    elapsed = time() - start
+
+    errors, delays = [], []
+    for uid, at in transitions.at.items():
+        if db.SENT not in at: continue
+        errors.append(at[db.SENT] - transitions.slots[uid])
+        delays.append(at[db.SENT] - transitions.recvs[uid])
+    errors.sort()
+
+    name = "batch" if _args.batch else "greedy"
+    print("Replayed {0} atoms over {1:.1f} simulated days in {2:.2f}s".format(len(recvs), span / 86400, elapsed))
+    scheduler = Scheduler(windows)
+    simulate = simulate_batch if _args.batch else simulate_greedy
+    report("model", simulate(scheduler, _args.count, recvs, _args.expire))
+    report("stages", (transitions.counts[db.SENT], transitions.counts[db.DROPPED], delays))
+    print("{0:7}: p50 {1:.0f}s, p99 {2:.0f}s, max {3:.0f}s after the slot ({4} scheduler)".format(
+        "sent", _percentile(errors, 0.5), _percentile(errors, 0.99), errors[-1] if errors else 0, name))
+    lost = len(recvs) - transitions.counts[db.SENT] - transitions.counts[db.DROPPED]
+    if lost: print("{0:7}: {1} atoms neither sent nor dropped".format("lost", lost))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,7 +1,20 @@
 from config import Config
 from stopwatch import StopWatch
+from clock import SystemClock, SimulatedClock
 import formatter
 from scheduler import Scheduler
+from crawler import Crawler
+from poller import PollPlanner
+from transitions import TransitionBuffer
+from dispatcher import Dispatcher
+import queues
+import shortener
+import dynamic
+import metrics
+import feedstream
+import httpclient
+import runtime
+import accounts
 import db
 import utils
 
@@ -10,7 +23,21 @@ __all__ = [
     "db",
     "utils",
     "StopWatch",
+    "SystemClock",
+    "SimulatedClock",
     "formatter",
     "Scheduler",
+    "Crawler",
+    "PollPlanner",
+    "TransitionBuffer",
+    "Dispatcher",
+    "queues",
+    "shortener",
+    "dynamic",
+    "metrics",
+    "feedstream",
+    "httpclient",
+    "runtime",
+    "accounts",
 ]
 
@@ -0,0 +1,60 @@
+import db
+
+
+def owner(accounts, account, workers):
+    """ The worker process that runs the pipeline for account """
+    return sorted(accounts).index(account) % workers
+
+
+def owned(accounts, index, workers):
+    """ The accounts run by worker index """
+    return [a for a in sorted(accounts) if owner(accounts, a, workers) == index]
+
+
+def owns_feed(feed_id, index, workers):
+    """ Each feed is fetched by exactly one worker, however many accounts use it """
+    return feed_id % workers == index
+
+
+class AccountRouter(object):
+    """ Fan new atoms out to the accounts subscribed to their feed.
+
+    route() runs inside the feed stage's transaction and records one
+    AccountAtom per subscribed account. An atom no account subscribes to
+    is marked SKIPPED so it can be archived. send() runs after the commit
+    and hands each copy to the inbox of the worker that owns the account.
+    """
+
+    def __init__(self, accounts, inboxes):
+        self._accounts = sorted(accounts)
+        self._inboxes = inboxes
+
+    def route(self, session, atoms):
+        """ Returns:
+            A list of (account, item) deliveries for send()
+        """
+        subscribers = db.FeedAccount.subscribers(set(a['feed_id'] for a in atoms), session)
+        deliveries = []
+        idle = []
+        for atom in atoms:
+            routed = len(deliveries)
+            for account in subscribers.get(atom['feed_id'], []):
+                if account not in self._accounts: continue
+                ident = db.account_ident(account, atom['ident'])
+                session.add(db.AccountAtom(
+                    account=account,
+                    uniq_id=ident,
+                    atom_uniq_id=atom['ident'],
+                    recv_dts=atom['recv'],
+                    status=db.RECIEVED,
+                ))
+                deliveries.append((account, dict(atom, ident=ident)))
+            if len(deliveries) == routed: idle.append(atom['ident'])
+
+        ## The subscribers query flushed the new atoms, so they can be updated in place
+        if idle: db.Atom.set_states([(db.SKIPPED, ident) for ident in idle], session)
+        return deliveries
+
+    def send(self, deliveries):
+        for account, item in deliveries:
+            self._inboxes[owner(self._accounts, account, len(self._inboxes))].put((account, item))
@@ -0,0 +1,204 @@
+from threading import Thread, Condition, Event, Lock
+from select import select
+import errno
+import fcntl
+import time
+import os
+from stopwatch import now_ns
+
+
+class SystemClock(object):
+    """ The real clock. Every pipeline stage uses one unless given another """
+
+    def time(self):
+        return time.time()
+
+    def now_ns(self):
+        return now_ns()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def condition(self, lock=None):
+        return Condition(lock)
+
+    def waker(self):
+        return _PipeWaker()
+
+    def spawn(self, name, target, kwargs=None, daemon=False):
+        thread = Thread(name=name, target=target, kwargs=kwargs or {})
+        thread.daemon = daemon
+        thread.start()
+        return thread
+
+
+class _PipeWaker(object):
+    """ wait() blocks in select() on a pipe until the timeout or a wake() """
+
+    def __init__(self):
+        self._r, self._w = os.pipe()
+        flags = fcntl.fcntl(self._w, fcntl.F_GETFL)
+        fcntl.fcntl(self._w, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def wake(self):
+        try:
+            os.write(self._w, b"x")
+        except OSError as e:
+            ## A full pipe already guarantees a wake-up
+            if e.errno != errno.EAGAIN: raise
+
+    def wait(self, timeout=None):
+        ready, _, _ = select([self._r], [], [], timeout)
+        if ready: os.read(self._r, 4096)
+
+
+class _Waiter(object):
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.event = Event()
+
+
+class SimulatedClock(object):
+    """ A clock that jumps straight to the next event.
+
+    Threads started with spawn() (or that call enter()) are participants.
+    Participants block through this clock: sleep(), its conditions and its
+    wakers. Once every participant is blocked, time jumps to the earliest
+    deadline among them and those waiters run. A week of scheduling replays
+    as fast as the stages can do their work.
+
+    Time never moves while a participant is running, so a stage sees the
+    same time throughout each step. A participant blocked outside the clock,
+    on a real lock or socket, holds time still until it returns. Threads
+    that are not participants must not block through the clock.
+    """
+
+    def __init__(self, start=0.0):
+        self._now = float(start)
+        self._lock = Lock()
+        self._participants = 0
+        self._parked = []
+
+    def time(self):
+        return self._now
+
+    def now_ns(self):
+        return int(self._now * 1000000000)
+
+    def sleep(self, seconds):
+        self._park(seconds).event.wait()
+
+    def condition(self, lock=None):
+        return _SimulatedCondition(self, lock or Lock())
+
+    def waker(self):
+        return _SimulatedWaker(self)
+
+    def enter(self):
+        """ Count the calling thread as a participant """
+        with self._lock:
+            self._participants += 1
+
+    def leave(self):
+        with self._lock:
+            self._participants -= 1
+            self._advance()
+
+    def spawn(self, name, target, kwargs=None, daemon=False):
+        """ Start target on a participant thread.
+
+        The thread is counted before it starts so time can't move on
+        before it first blocks.
+        """
+        def _run():
+            try:
+                target(**(kwargs or {}))
+            finally:
+                self.leave()
+
+        self.enter()
+        thread = Thread(name=name, target=_run)
+        thread.daemon = daemon
+        thread.start()
+        return thread
+
+    def _park(self, timeout):
+        with self._lock:
+            waiter = _Waiter(None if timeout is None else self._now + max(timeout, 0))
+            self._parked.append(waiter)
+            self._advance()
+        return waiter
+
+    def _unpark(self, waiter):
+        with self._lock:
+            if waiter in self._parked: self._parked.remove(waiter)
+        waiter.event.set()
+
+    def _advance(self):
+        """ Move to the earliest deadline once every participant is parked. Holds _lock """
+        if not self._parked or len(self._parked) < self._participants: return
+        deadlines = [w.deadline for w in self._parked if w.deadline is not None]
+        if not deadlines: return
+
+        self._now = max(self._now, min(deadlines))
+        for waiter in [w for w in self._parked if w.deadline is not None and w.deadline <= self._now]:
+            self._parked.remove(waiter)
+            waiter.event.set()
+
+
+class _SimulatedCondition(object):
+    """ threading.Condition with timeouts measured on a SimulatedClock """
+
+    def __init__(self, clock, lock):
+        self._clock = clock
+        self._lock = lock
+        self._waiters = []
+        self.acquire = lock.acquire
+        self.release = lock.release
+
+    def __enter__(self):
+        return self._lock.__enter__()
+
+    def __exit__(self, *exc):
+        return self._lock.__exit__(*exc)
+
+    def wait(self, timeout=None):
+        waiter = self._clock._park(timeout)
+        self._waiters.append(waiter)
+        self._lock.release()
+        try:
+            waiter.event.wait()
+        finally:
+            self._lock.acquire()
+            if waiter in self._waiters: self._waiters.remove(waiter)
+
+    def notify(self, n=1):
+        for waiter in list(self._waiters):
+            if n <= 0: break
+            self._waiters.remove(waiter)
+
+            ## Skip waiters that already timed out
+            if waiter.event.isSet(): continue
+            self._clock._unpark(waiter)
+            n -= 1
+
+    def notify_all(self):
+        self.notify(len(self._waiters))
+
+    notifyAll = notify_all
+
+
+class _SimulatedWaker(object):
+    def __init__(self, clock):
+        self._cond = clock.condition()
+        self._woken = False
+
+    def wake(self):
+        with self._cond:
+            self._woken = True
+            self._cond.notify_all()
+
+    def wait(self, timeout=None):
+        with self._cond:
+            if not self._woken: self._cond.wait(timeout)
+            self._woken = False
@@ -1,4 +1,5 @@
 import ConfigParser
+from copy import copy
 from os.path import isfile, expanduser, abspath
 import time
 
@@ -22,19 +23,24 @@ def _classFactory(name, section, params):
             if not cp.has_section(section):
                 cp.add_section(section)
 
-            for key,fn_fmt in params:
-                if name != key: continue
-                cp.set(section, key, str(value))
+            for param in params:
+                if name != param[0]: continue
+                cp.set(section, name, str(value))
                 return
 
             raise ConfigParser.NoOptionError("Invalid option '{0}' for section '{1}'".format(name, section))
                 
     def __init__(self, cp):
-        for key,fn_fmt in params:
+        for param in params:
+            key, fn_fmt = param[:2]
             try:
                 val = cp.get(section, key)
                 setattr(self, key, fn_fmt(val))
-            except ConfigParser.NoOptionError:
+            except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+                ## Optional parameters carry a default as a third element
+                if len(param) > 2:
+                    setattr(self, key, fn_fmt(param[2]))
+                    continue
                 raise KeyError("Missing required parameter '{0}' in section '{1}'".format(key, section))
             except ValueError:
                 raise ValueError("Invalid format for parameter '{0}' in section '{1}'".format(key,section))
@@ -46,14 +52,11 @@ def _classFactory(name, section, params):
 
 def _bool(s, setup=False):
     """A True or False value"""
-    if setup and s.lower() == "true":
+    if s.lower() == "true":
         return True
-    elif setup and s.lower() == "false":
+    elif s.lower() == "false":
         return False
-    elif setup:
-        raise ValueError("Valid values are 'True' and 'False'")
-
-    return bool(s)
+    raise ValueError("Valid values are 'True' and 'False'")
 
 def _int(s, setup=False):
     """A integer value"""
@@ -63,6 +66,12 @@ def _str(s, setup=False):
     """A clear text string"""
     return str(s)
 
+def _runtime(s, setup=False):
+    """How the pipeline stages run: threads or gevent"""
+    if s.lower() in ("threads", "gevent"):
+        return s.lower()
+    raise ValueError("Valid values are 'threads' and 'gevent'")
+
 def _time_list(s, setup=False):
     """A string representing a time. HH:MM:SS"""
     v = []
@@ -87,7 +96,11 @@ _configClasses = {
     'SCHEDULE' : _classFactory("ScheduleConfigClass", "SCHEDULE", [
                     ("dynamic_enabled", _bool), 
                     ("window_start", _time_list),
-                    ("window_duration", _int)
+                    ("window_duration", _int),
+                    ("batch_enabled", _bool, "False"),
+                    ("dynamic_windows", _int, "3"),
+                    ("dynamic_min_clicks", _int, "100"),
+                    ("dynamic_refresh", _int, "86400"),
                 ]),
     'TWEET_QUOTA' : _classFactory("QuotaConfigClass", "TWEET_QUOTA", [
                     ("count", _int), 
@@ -99,11 +112,20 @@ _configClasses = {
                     ("app", _str),
                     ("cred_path", _path), 
                     ("key", _str),
-                    ("secret", _str)
+                    ("secret", _str),
+                    ("domain", _str, "api.twitter.com"),
+                    ("secure", _bool, "True"),
                 ]),
     'BITLY_KEYS' : _classFactory("BitlyKeysConfigClass", "BITLY_KEYS", [
                     ("user", _str), 
                     ("key", _str),
+                    ("endpoint", _str, ""),
+                    ("cache_size", _int, "1024"),
+                    ("cache_ttl", _int, "86400"),
+                    ("workers", _int, "4"),
+                    ("rate_limit", _int, "100"),
+                    ("rate_burst", _int, "10"),
+                    ("retries", _int, "3"),
                 ]),
     'CALAIS_KEYS' : _classFactory("BitlyKeysConfigClass", "CALAIS_KEYS", [
                     ("key", _str),
@@ -112,12 +134,65 @@ _configClasses = {
                     ("dbschema", _str),
                     ("pidfile", _path_ghost),
                 ]),
+    'DB' : _classFactory("DbConfigClass", "DB", [
+                    ("pool_size", _int, "5"),
+                    ("max_overflow", _int, "10"),
+                    ("pool_recycle", _int, "3600"),
+                ]),
+    'FORMAT' : _classFactory("FormatConfigClass", "FORMAT", [
+                    ("tweet_length", _int, "140"),
+                    ("link_weight", _int, "0"),
+                    ("title_split", _int, "80"),
+                ]),
     'THREADS' : _classFactory("ThreadConfigClass", "THREADS", [
                     ("queue_size", _int),
                     ("atom_query_delta", _int),
+                    ("fetch_concurrency", _int, "8"),
+                    ("fetch_per_host", _int, "2"),
+                    ("fetch_timeout", _int, "20"),
+                    ("fetch_max_body", _int, "10485760"),
+                    ("poll_min_delta", _int, "300"),
+                    ("poll_max_delta", _int, "21600"),
+                    ("flush_size", _int, "50"),
+                    ("flush_delta", _int, "5"),
+                    ("queue_path", _str, ""),
+                    ("early_stop", _bool, "False"),
+                    ("runtime", _runtime, "threads"),
+                    ("workers", _int, "2"),
+                ]),
+    'METRICS' : _classFactory("MetricsConfigClass", "METRICS", [
+                    ("port", _int, "0"),
+                    ("bind", _str, "127.0.0.1"),
+                    ("log_delta", _int, "60"),
+                ]),
+    'RETENTION' : _classFactory("RetentionConfigClass", "RETENTION", [
+                    ("horizon", _int, "2592000"),
+                    ("compact_delta", _int, "0"),
+                    ("batch_size", _int, "500"),
                 ]),
 }
 
+## [ACCOUNT name] sections. A quota of 0 uses the [TWEET_QUOTA] value
+ACCOUNT_PREFIX = "ACCOUNT "
+_accountParams = [
+    ("app", _str),
+    ("cred_path", _path),
+    ("key", _str),
+    ("secret", _str),
+    ("domain", _str, "api.twitter.com"),
+    ("secure", _bool, "True"),
+    ("count", _int, "0"),
+    ("delta", _int, "0"),
+    ("joke_align", _int, "0"),
+    ("expire_delta", _int, "0"),
+]
+_QUOTA_KEYS = ("count", "delta", "joke_align", "expire_delta")
+
+
+class _Values(object):
+    pass
+
+
 class Config(object):
 
     path = None
@@ -157,7 +232,41 @@ class Config(object):
         cp = ConfigParser.ConfigParser()
         cp.read(path)
 
+        self.account = None
+        self.accounts = {}
         for s in cp.sections():
+            if s.startswith(ACCOUNT_PREFIX):
+                name = s[len(ACCOUNT_PREFIX):].strip()
+                self.accounts[name] = _classFactory("AccountConfigClass", s, _accountParams)(cp)
+                continue
             if s not in _configClasses:
                 raise KeyError("Unknown section '{0}' in configuration file".format(s))
             setattr(self, s.lower(), _configClasses[s](cp))
+
+        ## Sections left out of the file are still available if every
+        ## parameter in them has a default.
+        for s in _configClasses:
+            if cp.has_section(s): continue
+            try:
+                setattr(self, s.lower(), _configClasses[s](cp))
+            except KeyError:
+                pass
+
+    def for_account(self, name):
+        """ A view of this config for one [ACCOUNT name] section.
+
+        The account's Twitter keys replace [TWITTER_KEYS] and its non-zero
+        quota values override [TWEET_QUOTA]. Everything else is shared.
+        """
+        account = self.accounts[name]
+        view = copy(self)
+        view.account = name
+        view.twitter_keys = account
+
+        view.tweet_quota = copy(getattr(self, 'tweet_quota', None)) or _Values()
+        for key in _QUOTA_KEYS:
+            if getattr(account, key):
+                setattr(view.tweet_quota, key, getattr(account, key))
+            elif not hasattr(view.tweet_quota, key):
+                raise KeyError("Account '{0}' needs '{1}' or a [TWEET_QUOTA] section".format(name, key))
+        return view
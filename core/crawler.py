@@ -0,0 +1,145 @@
+from threading import Thread, Lock, BoundedSemaphore
+from Queue import Queue, Empty
+from urlparse import urlparse
+from stopwatch import now
+import feedparser
+import hashlib
+import httpclient
+
+CHANGED = "CHANGED"
+NOT_MODIFIED = "NOT_MODIFIED"
+UNCHANGED = "UNCHANGED"
+
+
+class FetchResult(object):
+    """ The outcome of fetching a single feed """
+
+    def __init__(self, key, url):
+        self.key = key
+        self.url = url
+        self.status = None
+        self.body = None
+        self.headers = None
+        self.error = None
+        self.elapsed = 0
+        self.etag = None
+        self.modified = None
+        self.content_hash = None
+        self.bytes = 0
+        self.connect_time = 0.0
+        self.transfer_time = 0.0
+
+    @property
+    def cache_hit(self):
+        return self.status in (NOT_MODIFIED, UNCHANGED)
+
+    def __repr__(self):
+        return "<FetchResult key({0}), url({1}), status({2}), error({3}), elapsed({4:.2f})>".format(
+            self.key,
+            self.url,
+            self.status,
+            self.error,
+            self.elapsed,
+        )
+
+
+class Crawler(object):
+    """ Download feeds in parallel.
+
+    No database access happens here. The caller hands over (key, url) jobs
+    and gets back the documents to parse and record in one short write step.
+    """
+
+    def __init__(self, concurrency=8, per_host=2, client=None):
+        self._client = client or httpclient.get_client()
+        self._concurrency = max(concurrency, 1)
+        self._per_host = max(per_host, 1)
+        self._hosts = {}
+        self._hosts_lock = Lock()
+
+    def _host_slot(self, url):
+        host = urlparse(url).netloc.lower()
+        with self._hosts_lock:
+            if host not in self._hosts:
+                self._hosts[host] = BoundedSemaphore(self._per_host)
+            return self._hosts[host]
+
+    def fetch_one(self, key, url, etag=None, modified=None, content_hash=None, timeout=None):
+        """ Fetch one feed.
+
+        The validators from the previous poll are sent along so the server can
+        answer 304. A body that hashes the same as content_hash is dropped.
+        timeout overrides the client default for this feed.
+        """
+        result = FetchResult(key, url)
+        with self._host_slot(url):
+            start = now()
+            try:
+                self._fetch(result, etag, modified, content_hash, timeout)
+            except Exception as e:
+                result.error = e
+            result.elapsed = now() - start
+        return result
+
+    def _fetch(self, result, etag, modified, content_hash, timeout):
+        headers = {'User-Agent': feedparser.USER_AGENT}
+        if etag: headers['If-None-Match'] = etag
+        if modified: headers['If-Modified-Since'] = modified
+
+        response = self._client.get(result.url, headers=headers, timeout=timeout)
+        result.bytes = response.bytes
+        result.connect_time = response.connect_time
+        result.transfer_time = response.transfer_time
+
+        if response.status == 304:
+            result.status = NOT_MODIFIED
+            return
+        if response.status != 200:
+            raise httpclient.HttpError(response.status, response.url)
+
+        body = response.body
+        headers = response.headers
+        result.etag = headers.get('etag')
+        result.modified = headers.get('last-modified')
+        result.content_hash = hashlib.md5(body).hexdigest()
+
+        if result.content_hash == content_hash:
+            result.status = UNCHANGED
+            return
+
+        headers.setdefault('content-location', response.url)
+        result.body = body
+        result.headers = headers
+        result.status = CHANGED
+
+    def fetch(self, jobs):
+        """ Fetch every (key, url, options) job.
+
+        options is a dict with the etag, modified and content_hash seen on
+        the previous poll and the feed timeout, or None.
+
+        Returns:
+            A list of FetchResult in the same order as jobs.
+        """
+        jobs = list(jobs)
+        results = [None] * len(jobs)
+        pending = Queue()
+        for n, job in enumerate(jobs):
+            pending.put((n, job))
+
+        def _worker():
+            while True:
+                try:
+                    n, (key, url, options) = pending.get_nowait()
+                except Empty:
+                    return
+                results[n] = self.fetch_one(key, url, **(options or {}))
+
+        workers = [Thread(target=_worker) for i in range(min(self._concurrency, len(jobs)))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        return results
@@ -1,9 +1,15 @@
 from sqlalchemy import *
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker, scoped_session
+from sqlalchemy.orm import relationship, sessionmaker, scoped_session, object_session
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy import event
+from threading import Lock
 from time import time, mktime
 import hashlib
 import feedparser
+import feedstream
+import httpclient
 
 Base = declarative_base()
 
@@ -15,7 +21,53 @@ DROPPED = "DROPPED"
 WAIT = "WAIT"
 SENT = "SENT"
 
-class Atom(Base):
+## Statuses an atom never leaves. Only these are archived
+FINAL = (SKIPPED, DROPPED, SENT)
+
+## Max number of values bound into a single IN clause
+_IN_CHUNK = 500
+
+
+class _Stateful(object):
+    """ Bulk status updates for tables keyed by uniq_id with status and bitly columns """
+
+    @classmethod
+    def set_states(cls, transitions, session):
+        """ Apply many state changes without loading the atoms.
+
+        Arguments:
+            transitions - An iterable of (status, uid) or (status, uid, short_link).
+                          Later entries for the same uid win.
+
+        Returns:
+            The number of atoms updated. Unknown uids are not counted.
+        """
+        latest = {}
+        for transition in transitions:
+            status, uid = transition[:2]
+            row = latest.setdefault(uid, {'_uid': uid})
+            row['_status'] = status
+            if len(transition) > 2 and transition[2]:
+                row['_bitly'] = transition[2]
+
+        table = cls.__table__
+        plain = [row for row in latest.values() if '_bitly' not in row]
+        linked = [row for row in latest.values() if '_bitly' in row]
+
+        updated = 0
+        if plain:
+            updated += session.execute(table.update()
+                .where(table.c.uniq_id == bindparam('_uid'))
+                .values(status=bindparam('_status')), plain).rowcount
+        if linked:
+            updated += session.execute(table.update()
+                .where(table.c.uniq_id == bindparam('_uid'))
+                .values(status=bindparam('_status'), bitly=bindparam('_bitly')), linked).rowcount
+
+        return updated
+
+
+class Atom(_Stateful, Base):
     """ Atom Log
     ID                < The application ID for ref
     FEED_ID           < The application ID for the Atom List
@@ -28,7 +80,7 @@ class Atom(Base):
 
     __tablename__ = "Atom"
     id = Column(Integer, primary_key=True)
-    feed_id = Column(Integer, ForeignKey('RssFeed.id'))
+    feed_id = Column(Integer, ForeignKey('RssFeed.id'), index=True)
     uniq_id = Column(String(255), nullable=False, unique=True)
     recv_dts = Column(Integer)
     publish_dts = Column(Integer)
@@ -54,7 +106,7 @@ class Atom(Base):
     def set_bitly(short_link, uid, session):
         atom = session.query(Atom).filter(Atom.uniq_id == uid).first()
         if atom: atom.bitly = short_link
-    
+
     def __repr__(self):
         return "<Atom id({0}), feed({1}), uniq({2}), recv({3}), sched({4}), status({5})>".format(
             self.id, 
@@ -73,6 +125,14 @@ class RssFeed(Base):
     URL               < The URL to the RSS Feed
     ORDER             < The order to scan for new atoms in each cycle.
     ENABLED           < If the feed is enaled
+    ETAG              < The ETag header from the last fetch
+    LAST_MODIFIED     < The Last-Modified header from the last fetch
+    CONTENT_HASH      < The md5 of the last fetched body
+    POLL_COUNT        < Number of times the feed was fetched
+    CACHE_HITS        < Number of fetches answered by 304 or an identical body
+    TEMPLATE          < The tweet layout for atoms from this feed. Uses the default if empty
+    TIMEOUT           < Seconds to wait on this feed's server. Uses the client default if empty
+    SUBSCRIPTIONS     < FeedAccount rows naming the accounts that tweet this feed
     """
 
     __tablename__ = "RssFeed"
@@ -82,7 +142,15 @@ class RssFeed(Base):
     url = Column(String(255), unique=True)
     order = Column(Integer)
     enable = Column(Boolean)
+    etag = Column(String(255))
+    last_modified = Column(String(255))
+    content_hash = Column(String(32))
+    poll_count = Column(Integer, default=0)
+    cache_hits = Column(Integer, default=0)
+    template = Column(String(255))
+    timeout = Column(Integer)
     atoms = relationship("Atom", backref="feed")
+    subscriptions = relationship("FeedAccount", cascade="all, delete-orphan")
 
     def __init__(self, **kwargs):
         self.id = kwargs.get('id', None)
@@ -91,10 +159,43 @@ class RssFeed(Base):
         self.url = kwargs.get('url', None)
         self.order = kwargs.get('order', None)
         self.enable = kwargs.get('enable', None)
+        self.poll_count = kwargs.get('poll_count', 0)
+        self.cache_hits = kwargs.get('cache_hits', 0)
+        self.template = kwargs.get('template', None)
+        self.timeout = kwargs.get('timeout', None)
+        self.subscriptions = kwargs.get('subscriptions', [])
+
+    def fetch_options(self):
+        """ The cache validators and timeout to use for the next fetch """
+        return dict(etag=self.etag, modified=self.last_modified, content_hash=self.content_hash, timeout=self.timeout)
+
+    def record_fetch(self, result):
+        """ Update the cache validators and counters from a crawler.FetchResult """
+        self.poll_count = (self.poll_count or 0) + 1
+        if result.cache_hit:
+            self.cache_hits = (self.cache_hits or 0) + 1
+        if result.etag: self.etag = result.etag
+        if result.modified: self.last_modified = result.modified
+        if result.content_hash: self.content_hash = result.content_hash
+
+    def publish_history(self, limit=20):
+        """ The most recent publish timestamps recorded for this feed """
+        session = object_session(self)
+        if not session:
+            return [a.publish_dts for a in self.atoms]
+        return [ts for (ts,) in session.query(Atom.publish_dts)
+                .filter(Atom.feed_id == self.id)
+                .order_by(Atom.publish_dts.desc())
+                .limit(limit)]
+
+    def cache_ratio(self):
+        if not self.poll_count: return 0.0
+        return float(self.cache_hits or 0) / self.poll_count
 
     @staticmethod
-    def new(url, hashtags=None, order=500, enable=True):
-        feed = feedparser.parse(url)
+    def new(url, hashtags=None, order=500, enable=True, template=None, timeout=None, accounts=None):
+        body, headers = _download(url, timeout)
+        feed = feedparser.parse(body, response_headers=headers)
         if not feed: return None
 
         _htags = " ".join(hashtags) if hashtags else ""
@@ -106,51 +207,120 @@ class RssFeed(Base):
             url = url,
             order = order,
             enable = enable,
+            template = template,
+            timeout = timeout,
+            subscriptions = [FeedAccount(account=a) for a in (accounts or [])],
         )
 
-    def get_new_atoms(self, status="RECIEVED"):
+    def get_new_atoms(self, status="RECIEVED", feed=None, body=None, headers=None, early_stop=False):
         """ Query the feed and find new atoms.
         
         New atoms will automaticly be added to the database with the provided status (default: "RECIEVED")
         
         Arguments:
             status - Optional: The staus to set the new records to
+            feed - Optional: An already parsed copy of the feed.
+            body - Optional: The raw feed document. It is parsed as a stream.
+            headers - Optional: The HTTP response headers that came with body.
+            early_stop - Optional: Stop at the first entry that is already known.
+                         Only safe for feeds that list their newest entries first.
+
+            The feed is fetched if neither feed nor body is given.
         """
         required_keys = ['title', 'published_parsed', 'link', 'title_detail', 'tags']
 
-        feed = feedparser.parse(self.url)
-        for atom in feed['items']:
-
-            if all(req_key in atom for req_key in required_keys) and atom['title_detail']['type'] == 'text/plain':
-                link = atom['link']
-                ident = hashlib.md5(link).hexdigest()
-                recv = int(time())
-
-                ## Make sure it's new
-                if ident in [a.uniq_id for a in self.atoms]: continue
-
-                ## update the tags
-                #tags = set(["#"+tag['term'].encode("ascii", errors="ignore").title().replace(' ', '') for tag in atom['tags']])
-                tags = set()
-                for _t in self.hashtags.split(' '):
-                    tags.add(_t.encode("ascii", errors="ignore"))
-
-                ## Add to child
-                self.atoms.append(Atom(
-                    uniq_id=ident,
-                    recv_dts=recv,
-                    publish_dts=int(mktime(atom['published_parsed'])),
-                    status=status
-                ))
-
-                yield {
-                    'title':atom['title_detail']['value'].encode("ascii", errors="ignore"),
-                    'body':atom.get('summary', None),
-                    'link':link,
-                    'tags':tags,
-                    'ident':ident,
-                    'recv':recv,
-                }
+        if feed is not None:
+            entries = feed['items']
+        elif body is not None:
+            entries = feedstream.entries(body, headers)
+        else:
+            entries = feedstream.entries(*_download(self.url, self.timeout))
+
+        session = object_session(self)
+        candidates = ((hashlib.md5(atom['link']).hexdigest(), atom) for atom in entries
+                      if all(req_key in atom for req_key in required_keys) and atom['title_detail']['type'] == 'text/plain')
+
+        if early_stop:
+            candidates = self._until_known(candidates)
+            known = set()
+        else:
+            ## One lookup for every candidate instead of walking the atom history
+            candidates = list(candidates)
+            known = self._known_uniq_ids([ident for ident, atom in candidates])
+
+        for ident, atom in candidates:
+
+            ## Make sure it's new
+            if ident in known: continue
+            known.add(ident)
+
+            link = atom['link']
+            recv = int(time())
+
+            ## update the tags
+            #tags = set(["#"+tag['term'].encode("ascii", errors="ignore").title().replace(' ', '') for tag in atom['tags']])
+            tags = set()
+            for _t in self.hashtags.split(' '):
+                tags.add(_t.encode("ascii", errors="ignore"))
+
+            ## Add to child. Appending to self.atoms would load the feed's whole
+            ## history, so a feed that is already stored adds the row directly
+            record = Atom(
+                uniq_id=ident,
+                recv_dts=recv,
+                publish_dts=int(mktime(atom['published_parsed'])),
+                status=status
+            )
+            if session and self.id is not None:
+                record.feed_id = self.id
+                session.add(record)
+            else:
+                self.atoms.append(record)
+
+            yield {
+                'title':atom['title_detail']['value'].encode("ascii", errors="ignore"),
+                'body':atom.get('summary', None),
+                'link':link,
+                'tags':tags,
+                'ident':ident,
+                'recv':recv,
+                'feed_id':self.id,
+                'template':self.template,
+            }
+
+    def _until_known(self, candidates):
+        """ Pass candidates through until one is already recorded """
+        for ident, atom in candidates:
+            if self._known_uniq_ids([ident]): return
+            yield ident, atom
+
+    def _known_uniq_ids(self, idents):
+        """ Find which of the given uniq_ids are already recorded.
+
+        Uses the unique index on Atom.uniq_id, then the primary key of
+        AtomArchive for the rest, so the cost does not depend on how many
+        atoms the feed has collected.
+        """
+        session = object_session(self)
+        if not session:
+            return set(a.uniq_id for a in self.atoms)
+
+        known = set()
+        for model in (Atom, AtomArchive):
+            idents = [ident for ident in idents if ident not in known]
+            for i in range(0, len(idents), _IN_CHUNK):
+                chunk = idents[i:i+_IN_CHUNK]
+                for (uid,) in session.query(model.uniq_id).filter(model.uniq_id.in_(chunk)):
+                    known.add(uid)
+        return known
+
+    def atom_count(self):
+        """ The number of atoms recorded for this feed, archived ones included """
+        session = object_session(self)
+        if not session:
+            return len(self.atoms)
+        return sum(session.query(func.count(model.uniq_id)).filter(model.feed_id == self.id).scalar()
+                   for model in (Atom, AtomArchive))
 
     def __repr__(self):
         return "<RssFeed id({0}), name({1}), order({2}), enable({3})>".format(
@@ -161,6 +331,27 @@ class RssFeed(Base):
         )
 
 
+class AtomArchive(Base):
+    """ Archived Atom
+    UNIQ_ID           < The UNIQ_ID of an atom moved out of the Atom table. Kept for dedup
+    FEED_ID           < The application ID of the feed the atom came from
+    """
+
+    __tablename__ = "AtomArchive"
+    uniq_id = Column(String(32), primary_key=True)
+    feed_id = Column(Integer, index=True)
+
+    def __init__(self, **kwargs):
+        self.uniq_id = kwargs.get('uniq_id', None)
+        self.feed_id = kwargs.get('feed_id', None)
+
+    def __repr__(self):
+        return "<AtomArchive uniq({0}), feed({1})>".format(
+            self.uniq_id,
+            self.feed_id,
+        )
+
+
 class Joke(Base):
     """ Joke
     ID                < The application ID to ref
@@ -231,14 +422,295 @@ class Tweet(Base):
         )
 
 
+class FeedAccount(Base):
+    """ Feed Subscription
+    FEED_ID           < The application ID of the RSS Feed
+    ACCOUNT           < The name of an [ACCOUNT name] section that tweets atoms from the feed
+    """
+
+    __tablename__ = "FeedAccount"
+    feed_id = Column(Integer, ForeignKey('RssFeed.id'), primary_key=True)
+    account = Column(String(64), primary_key=True)
+
+    def __init__(self, **kwargs):
+        self.feed_id = kwargs.get('feed_id', None)
+        self.account = kwargs.get('account', None)
+
+    @staticmethod
+    def subscribers(feed_ids, session):
+        """ Map each of feed_ids to the accounts subscribed to it """
+        feed_ids = list(feed_ids)
+        found = {}
+        for i in range(0, len(feed_ids), _IN_CHUNK):
+            for feed_id, account in session.query(FeedAccount.feed_id, FeedAccount.account).filter(
+                    FeedAccount.feed_id.in_(feed_ids[i:i+_IN_CHUNK])):
+                found.setdefault(feed_id, []).append(account)
+        return found
+
+    def __repr__(self):
+        return "<FeedAccount feed({0}), account({1})>".format(
+            self.feed_id,
+            self.account,
+        )
+
+
+class AccountAtom(_Stateful, Base):
+    """ Account Atom Log
+    ID                < The application ID for ref
+    ACCOUNT           < The account this atom is tweeted from
+    UNIQ_ID           < account_ident(ACCOUNT, ATOM_UNIQ_ID). The key used in the pipeline
+    ATOM_UNIQ_ID      < The UNIQ_ID of the shared Atom record
+    RECV_DTS          < The unix timestamp the atom was recieved
+    BITLY             < The bitly associated with this atom.
+    STATUS            < The status of this atom in the account's pipeline
+    """
+
+    __tablename__ = "AccountAtom"
+    id = Column(Integer, primary_key=True)
+    account = Column(String(64), nullable=False, index=True)
+    uniq_id = Column(String(255), nullable=False, unique=True)
+    atom_uniq_id = Column(String(255), nullable=False, index=True)
+    recv_dts = Column(Integer)
+    bitly = Column(String(255))
+    status = Column(String(255))
+
+    def __init__(self, **kwargs):
+        self.account = kwargs.get('account', None)
+        self.uniq_id = kwargs.get('uniq_id', None)
+        self.atom_uniq_id = kwargs.get('atom_uniq_id', None)
+        self.recv_dts = kwargs.get('recv_dts', None)
+        self.bitly = kwargs.get('bitly', None)
+        self.status = kwargs.get('status', None)
+
+    def __repr__(self):
+        return "<AccountAtom id({0}), account({1}), uniq({2}), status({3})>".format(
+            self.id,
+            self.account,
+            self.uniq_id,
+            self.status,
+        )
+
+
+def account_ident(account, uniq_id):
+    """ The pipeline key of an atom tweeted from account """
+    return "{0}/{1}".format(account, uniq_id)
+
+
+def compact(session, before, batch_size=_IN_CHUNK):
+    """ Archive one batch of finished atoms received before the given time.
+
+    Each Atom is replaced by an AtomArchive row, so it is still recognized
+    when its feed lists it again. With accounts the shared Atom keeps its
+    RECIEVED status, so it is finished once every AccountAtom of it is.
+    Finished AccountAtom records are deleted outright, but only after their
+    Atom is archived. Call it until it returns (0, 0), committing in between.
+
+    Returns:
+        A tuple (archived atoms, deleted account atoms)
+    """
+    routed = exists().where(AccountAtom.atom_uniq_id == Atom.uniq_id)
+    pending = exists().where(and_(AccountAtom.atom_uniq_id == Atom.uniq_id, ~AccountAtom.status.in_(FINAL)))
+    rows = session.query(Atom.id, Atom.uniq_id, Atom.feed_id).filter(
+        or_(Atom.status.in_(FINAL), and_(routed, ~pending)), Atom.recv_dts < before).order_by(Atom.id).limit(batch_size).all()
+    if rows:
+        session.execute(AtomArchive.__table__.insert(), [{'uniq_id': uid, 'feed_id': feed_id} for _, uid, feed_id in rows])
+        session.execute(Atom.__table__.delete().where(Atom.id.in_([row[0] for row in rows])))
+
+    archived = ~exists().where(Atom.uniq_id == AccountAtom.atom_uniq_id)
+    ids = [atom_id for (atom_id,) in session.query(AccountAtom.id).filter(
+        AccountAtom.status.in_(FINAL), AccountAtom.recv_dts < before, archived).order_by(AccountAtom.id).limit(batch_size)]
+    if ids:
+        session.execute(AccountAtom.__table__.delete().where(AccountAtom.id.in_(ids)))
+
+    return len(rows), len(ids)
+
+
+class Click(Base):
+    """ Click
+    ID                < The application ID for ref
+    BITLY             < The short link that was clicked
+    CLICKED_DTS       < The unix timestamp of the start of the hour the clicks happened in
+    CLICKS            < The number of clicks in that hour
+    """
+
+    __tablename__ = "Click"
+    __table_args__ = (UniqueConstraint('bitly', 'clicked_dts'),)
+    id = Column(Integer, primary_key=True)
+    bitly = Column(String(255), nullable=False)
+    clicked_dts = Column(Integer, nullable=False)
+    clicks = Column(Integer)
+
+    def __init__(self, **kwargs):
+        self.id = kwargs.get('id', None)
+        self.bitly = kwargs.get('bitly', None)
+        self.clicked_dts = kwargs.get('clicked_dts', None)
+        self.clicks = kwargs.get('clicks', 0)
+
+    def __repr__(self):
+        return "<Click id({0}), bitly({1}), clicked({2}), clicks({3})>".format(
+            self.id,
+            self.bitly,
+            self.clicked_dts,
+            self.clicks,
+        )
+
+
+class ClickHour(Base):
+    """ Click totals by hour of the week
+    HOUR              < Local hour of the week. 0 is Monday 00:00
+    CLICKS            < The number of clicks recorded in that hour
+    """
+
+    __tablename__ = "ClickHour"
+    hour = Column(Integer, primary_key=True, autoincrement=False)
+    clicks = Column(Integer)
+
+    def __init__(self, **kwargs):
+        self.hour = kwargs.get('hour', None)
+        self.clicks = kwargs.get('clicks', 0)
+
+    def __repr__(self):
+        return "<ClickHour hour({0}), clicks({1})>".format(
+            self.hour,
+            self.clicks,
+        )
+
+
+class _TimedQueuePool(QueuePool):
+    """ QueuePool that records how long each checkout waited for a connection """
+
+    def _do_get(self):
+        start = time()
+        try:
+            return QueuePool._do_get(self)
+        finally:
+            stats = getattr(self, "_stats", None)
+            if stats is not None:
+                _count(stats, 'checkout_time', time() - start)
+
+
+_registry = {}
+_registry_lock = Lock()
+_pool_options = {}
+
+## Checkouts happen on every thread, so the pool counters share one lock
+_stats_lock = Lock()
+
+
+def _download(url, timeout=None):
+    """ Fetch a feed document through the shared HTTP client
+
+    Returns:
+        (body, headers) ready for the parser.
+    """
+    response = httpclient.get_client().get(url, headers={'User-Agent': feedparser.USER_AGENT}, timeout=timeout)
+    if response.status != 200:
+        raise httpclient.HttpError(response.status, response.url)
+    response.headers.setdefault('content-location', response.url)
+    return response.body, response.headers
+
+
+def configure(dbschema, pool_size=5, max_overflow=10, pool_recycle=3600):
+    """ Set the pool options used when the engine for dbschema is first built.
+
+    Must be called before the first Session(dbschema) to take effect.
+    """
+    _pool_options[dbschema] = dict(
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_recycle=pool_recycle,
+    )
+
+
+def _new_stats():
+    return {
+        'hits': 0,
+        'misses': 0,
+        'checkouts': 0,
+        'checkout_time': 0.0,
+    }
+
+
+def _count(stats, key, amount=1):
+    with _stats_lock:
+        stats[key] += amount
+
+
+def _create_engine(dbschema, stats):
+    url = make_url(dbschema)
+
+    ## In-memory sqlite databases exist per connection, so they can not be
+    ## spread across a pool.
+    sqlite = url.drivername.startswith("sqlite")
+    if sqlite and url.database in (None, "", ":memory:"):
+        engine = create_engine(dbschema)
+    elif sqlite:
+        ## Every stage writes on its own connection, so wait on the file lock
+        ## instead of failing with "database is locked". Pooled connections
+        ## move between threads but never serve two at once.
+        engine = create_engine(dbschema, poolclass=_TimedQueuePool,
+                               connect_args={'timeout': 30, 'check_same_thread': False},
+                               **_pool_options.get(dbschema, {}))
+        engine.pool._stats = stats
+    else:
+        engine = create_engine(dbschema, poolclass=_TimedQueuePool, **_pool_options.get(dbschema, {}))
+        engine.pool._stats = stats
+
+    def _on_connect(dbapi_con, con_record):
+        _count(stats, 'misses')
+        ## WAL lets the stages read while another one writes
+        if sqlite and url.database not in (None, "", ":memory:"):
+            dbapi_con.execute("PRAGMA journal_mode=WAL")
+
+    def _on_checkout(dbapi_con, con_record, con_proxy):
+        _count(stats, 'checkouts')
+
+    event.listen(engine, "connect", _on_connect)
+    event.listen(engine, "checkout", _on_checkout)
+    return engine
+
+
+def get_engine(dbschema):
+    """ Get the shared engine for dbschema, creating it on first use """
+    return _get_entry(dbschema)[0]
+
+
+def _get_entry(dbschema):
+    with _registry_lock:
+        entry = _registry.get(dbschema)
+        if not entry:
+            stats = _new_stats()
+            engine = _create_engine(dbschema, stats)
+            entry = _registry[dbschema] = (engine, scoped_session(sessionmaker(bind=engine)), stats)
+        return entry
+
+
+def pool_stats(dbschema):
+    """ Get the connection pool counters for dbschema.
+
+    Returns:
+        A dict with hits, misses, checkouts and checkout_time (seconds).
+        A hit is a checkout served by an already open connection and a
+        miss is a checkout that had to open a new one.
+    """
+    with _registry_lock:
+        entry = _registry.get(dbschema)
+    with _stats_lock:
+        stats = dict(entry[2]) if entry else _new_stats()
+
+    stats['hits'] = max(stats['checkouts'] - stats['misses'], 0)
+    return stats
+
+
 def Session(dbschema):
-    """ Create a session """
-    engine = create_engine(dbschema)
-    return scoped_session(sessionmaker(bind=engine))
+    """ Get a session from the shared engine for dbschema
+
+    Sessions are thread local. Closing one returns its connection to the pool.
+    """
+    return _get_entry(dbschema)[1]
 
 
 def install(dbschema):
     """ Create the database """
-    engine = create_engine(dbschema)
-    Base.metadata.create_all(engine)
+    Base.metadata.create_all(get_engine(dbschema))
 
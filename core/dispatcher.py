@@ -0,0 +1,53 @@
+from heapq import heappush, heappop
+from threading import Lock
+from clock import SystemClock
+
+
+class Dispatcher(object):
+    """ Hand out items when their deadline arrives, earliest first.
+
+    next() blocks on the clock's waker until the earliest deadline. With the
+    system clock that is select() on a wake-up pipe, so an idle dispatcher
+    costs nothing and a push() or close() from another thread wakes it
+    straight away.
+    """
+
+    def __init__(self, clock=None):
+        self._clock = clock or SystemClock()
+        self._heap = []
+        self._seq = 0
+        self._closed = False
+        self._lock = Lock()
+        self._waker = self._clock.waker()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._heap)
+
+    def push(self, deadline, item):
+        with self._lock:
+            heappush(self._heap, (deadline, self._seq, item))
+            self._seq += 1
+        self._waker.wake()
+
+    def close(self):
+        """ Make next() return None. Pending items are abandoned """
+        with self._lock:
+            self._closed = True
+        self._waker.wake()
+
+    def next(self):
+        """ Wait for the earliest item to come due.
+
+        Returns:
+            The item, or None once the dispatcher is closed.
+        """
+        while True:
+            with self._lock:
+                if self._closed: return None
+                now = self._clock.time()
+                if self._heap and self._heap[0][0] <= now:
+                    return heappop(self._heap)[2]
+                timeout = self._heap[0][0] - now if self._heap else None
+
+            self._waker.wait(timeout)
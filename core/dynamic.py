@@ -0,0 +1,183 @@
+from sqlalchemy import func
+import time
+import bitly_api
+import db
+
+HOURS_PER_WEEK = 7*24
+
+
+def hour_of_week(ts):
+    """ The local hour of the week ts falls in. 0 is Monday 00:00 """
+    lt = time.localtime(ts)
+    return lt.tm_wday * 24 + lt.tm_hour
+
+
+class ClickHistogram(object):
+    """ Click counts by hour of the week.
+
+    Events are folded in one at a time, so any number of them can be
+    aggregated in constant memory.
+    """
+
+    def __init__(self, counts=None):
+        self.counts = list(counts) if counts else [0] * HOURS_PER_WEEK
+
+    def add(self, ts, clicks=1):
+        self.counts[hour_of_week(ts)] += clicks
+
+    def ingest(self, events):
+        """ Fold in an iterable of (timestamp, clicks) """
+        for ts, clicks in events:
+            self.counts[hour_of_week(ts)] += clicks
+        return self
+
+    def total(self):
+        return sum(self.counts)
+
+    def top_windows(self, count, duration):
+        """ The busiest windows of the week.
+
+        Returns:
+            A list of up to count (offset, duration) tuples, where offset is
+            seconds after Monday 00:00. Windows are picked busiest first and
+            never overlap.
+        """
+        span = max((duration + 3599) // 3600, 1)
+
+        ## Clicks in each window of `span` hours, wrapping around the week
+        sums = []
+        for hour in range(HOURS_PER_WEEK):
+            sums.append(sum(self.counts[(hour + n) % HOURS_PER_WEEK] for n in range(span)))
+
+        windows = []
+        taken = set()
+        for hour in sorted(range(HOURS_PER_WEEK), key=lambda h: (-sums[h], h)):
+            if len(windows) >= count or sums[hour] == 0: break
+            hours = set((hour + n) % HOURS_PER_WEEK for n in range(span))
+            if hours & taken: continue
+            taken |= hours
+            windows.append((hour * 3600, duration))
+
+        return sorted(windows)
+
+
+class BitlyClickFetcher(object):
+    """ Fetch hourly click counts for a short link from bit.ly """
+
+    def __init__(self, user, key):
+        self._bitly = bitly_api.Connection(user, access_token=key)
+
+    def fetch(self, short_link, since):
+        """ Yield (timestamp, clicks) for the hour starting at since and every hour after it """
+        for row in self._bitly.link_clicks(short_link, unit='hour', units=-1, rollup=False):
+            if row['dt'] >= since and row['clicks']:
+                yield row['dt'], row['clicks']
+
+
+class DynamicWindows(object):
+    """ Derive tweet windows from when our short links get clicked.
+
+    refresh() asks the fetcher for new clicks on recently sent links, keeps
+    them in the Click table and folds them into the ClickHour histogram in
+    the same transaction. windows() returns the busiest windows once enough
+    clicks have been seen, or None so the caller keeps its static windows.
+    """
+
+    def __init__(self, dbschema, fetcher, min_clicks=100, lookback=7*24*60*60):
+        self._dbschema = dbschema
+        self._fetcher = fetcher
+        self._min_clicks = min_clicks
+        self._lookback = lookback
+
+    def histogram(self):
+        session = db.Session(self._dbschema)
+        try:
+            histogram = ClickHistogram()
+            for row in session.query(db.ClickHour):
+                histogram.counts[row.hour] = row.clicks or 0
+            return histogram
+        finally:
+            session.close()
+
+    def rebuild(self):
+        """ Recount the histogram from every stored click """
+        session = db.Session(self._dbschema)
+        try:
+            histogram = ClickHistogram().ingest(
+                session.query(db.Click.clicked_dts, db.Click.clicks).yield_per(10000))
+            session.query(db.ClickHour).delete()
+            for hour, clicks in enumerate(histogram.counts):
+                session.add(db.ClickHour(hour=hour, clicks=clicks))
+            session.commit()
+            return histogram
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def refresh(self, now=None):
+        """ Fetch new clicks for links sent within the lookback period.
+
+        Returns:
+            The number of click rows stored or updated.
+        """
+        if now is None: now = int(time.time())
+        session = db.Session(self._dbschema)
+        try:
+            links = [link for (link,) in session.query(db.Atom.bitly).distinct()
+                     .filter(db.Atom.status == db.SENT, db.Atom.bitly != None,
+                             db.Atom.recv_dts >= now - self._lookback)]
+            last = {}
+            for n in range(0, len(links), 500):
+                last.update(session.query(db.Click.bitly, func.max(db.Click.clicked_dts))
+                            .filter(db.Click.bitly.in_(links[n:n+500])).group_by(db.Click.bitly))
+        finally:
+            session.close()
+
+        ## Each link is fetched with no session open and written in its own
+        ## short transaction. The newest stored hour may have been stored
+        ## before it was over, so it is fetched again and updated in place.
+        stored = 0
+        for link in links:
+            since = last.get(link) or 0
+            hourly = {}
+            for ts, clicks in self._fetcher.fetch(link, since):
+                hourly[ts] = hourly.get(ts, 0) + clicks
+            if not hourly: continue
+
+            session = db.Session(self._dbschema)
+            try:
+                delta = ClickHistogram()
+                for ts, clicks in hourly.items():
+                    row = None
+                    if ts == since:
+                        row = session.query(db.Click).filter(db.Click.bitly == link, db.Click.clicked_dts == ts).first()
+                    if row:
+                        if clicks == row.clicks: continue
+                        delta.add(ts, clicks - (row.clicks or 0))
+                        row.clicks = clicks
+                    else:
+                        session.add(db.Click(bitly=link, clicked_dts=ts, clicks=clicks))
+                        delta.add(ts, clicks)
+                    stored += 1
+                self._fold(session, delta)
+                session.commit()
+            except:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+        return stored
+
+    def _fold(self, session, delta):
+        for hour, clicks in enumerate(delta.counts):
+            if not clicks: continue
+            row = session.query(db.ClickHour).get(hour)
+            if row: row.clicks = (row.clicks or 0) + clicks
+            else: session.add(db.ClickHour(hour=hour, clicks=clicks))
+
+    def windows(self, count, duration):
+        histogram = self.histogram()
+        if histogram.total() < self._min_clicks: return None
+        return histogram.top_windows(count, duration)
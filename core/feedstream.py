@@ -0,0 +1,127 @@
+from xml.etree import cElementTree as ElementTree
+from email.utils import parsedate_tz, mktime_tz
+from calendar import timegm
+from io import BytesIO
+import feedparser
+import time
+import re
+
+_ATOM = "{http://www.w3.org/2005/Atom}"
+_RSS1 = "{http://purl.org/rss/1.0/}"
+_CONTENT = "{http://purl.org/rss/1.0/modules/content/}"
+
+_ENTRY_TAGS = set(["item", _RSS1 + "item", _ATOM + "entry"])
+_HTML = re.compile(r"<[a-zA-Z/!]")
+_ISO8601 = re.compile(r"(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2})(?::(\d{2}))?(?:\.\d+)?\s*(Z|[+-]\d{2}:?\d{2})?$")
+_ATOM_TYPES = {
+    'text': 'text/plain',
+    'html': 'text/html',
+    'xhtml': 'application/xhtml+xml',
+}
+
+
+def _parse_rfc822(value):
+    parsed = parsedate_tz(value)
+    if not parsed: return None
+    return time.gmtime(mktime_tz(parsed))
+
+
+def _parse_iso8601(value):
+    m = _ISO8601.match(value.strip())
+    if not m: return None
+    year, month, day, hour, minute, second, zone = m.groups()
+    ts = timegm((int(year), int(month), int(day), int(hour), int(minute), int(second or 0), 0, 0, 0))
+    if zone and zone != "Z":
+        offset = int(zone[1:3]) * 3600 + int(zone[-2:]) * 60
+        ts -= offset if zone[0] == "+" else -offset
+    return time.gmtime(ts)
+
+
+def _text(elem):
+    return (elem.text or "").strip()
+
+
+def _rss_entry(elem):
+    entry = {}
+    tags = []
+    guid = None
+    for child in elem:
+        tag = child.tag
+        if tag in ("title", _RSS1 + "title"):
+            value = _text(child)
+            entry['title'] = value
+            entry['title_detail'] = {'type': 'text/html' if _HTML.search(value) else 'text/plain', 'value': value}
+        elif tag in ("link", _RSS1 + "link"):
+            entry['link'] = _text(child)
+        elif tag == "guid":
+            ## isPermaLink defaults to true, and then the guid is the item's link
+            if child.get('isPermaLink', 'true').lower() != 'false': guid = _text(child)
+        elif tag in ("description", _RSS1 + "description", _CONTENT + "encoded"):
+            entry.setdefault('summary', child.text or "")
+        elif tag == "pubDate":
+            published = _parse_rfc822(_text(child))
+            if published: entry['published_parsed'] = published
+        elif tag == "category":
+            tags.append({'term': _text(child)})
+    if guid and 'link' not in entry: entry['link'] = guid
+    if tags: entry['tags'] = tags
+    return entry
+
+
+def _atom_entry(elem):
+    entry = {}
+    tags = []
+    for child in elem:
+        tag = child.tag
+        if tag == _ATOM + "title":
+            value = "".join(child.itertext()).strip()
+            entry['title'] = value
+            entry['title_detail'] = {'type': _ATOM_TYPES.get(child.get('type', 'text'), 'text/plain'), 'value': value}
+        elif tag == _ATOM + "link":
+            if child.get('rel', 'alternate') == 'alternate' and 'link' not in entry:
+                entry['link'] = child.get('href', '')
+        elif tag in (_ATOM + "summary", _ATOM + "content"):
+            entry.setdefault('summary', "".join(child.itertext()))
+        elif tag in (_ATOM + "published", _ATOM + "issued"):
+            published = _parse_iso8601(_text(child))
+            if published: entry['published_parsed'] = published
+        elif tag == _ATOM + "category":
+            tags.append({'term': child.get('term', '')})
+    if tags: entry['tags'] = tags
+    return entry
+
+
+def iter_entries(body):
+    """ Yield the entries of an RSS or Atom document as they are parsed.
+
+    Entries have the keys get_new_atoms uses from feedparser items. Each
+    entry's elements are freed once it is yielded, and stopping early stops
+    the parse.
+
+    Raises:
+        SyntaxError if the document is not well formed XML
+    """
+    root = None
+    for event, elem in ElementTree.iterparse(BytesIO(body), events=("start", "end")):
+        if event == "start":
+            if root is None: root = elem
+            continue
+        if elem.tag not in _ENTRY_TAGS: continue
+
+        entry = _atom_entry(elem) if elem.tag.startswith(_ATOM) else _rss_entry(elem)
+        elem.clear()
+        root.clear()
+        yield entry
+
+
+def entries(body, headers=None):
+    """ Stream the entries of a feed, falling back to feedparser for malformed feeds """
+    seen = set()
+    try:
+        for entry in iter_entries(body):
+            seen.add(entry.get('link'))
+            yield entry
+    except SyntaxError:
+        for entry in feedparser.parse(body, response_headers=headers or {})['items']:
+            if entry.get('link') in seen: continue
+            yield entry
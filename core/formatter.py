@@ -1,25 +1,100 @@
+from string import Formatter
+from threading import Lock
+
 #from calais import Calais
 
-def format_atom(item, config):
-    #calais = Calais(config.calais_keys.key)
-    link = item['short_link']
-    title_short = item['title'][:80]
-    title_ext = item['title'][80:]
+DEFAULT_TEMPLATE = "{title}\n{link}\n{tags}"
+FIELDS = ("title", "link", "tags")
 
-    #r = calais.analyze_url(i['link'])
 
-    tags = ""
-    for tag in item['tags']:
-        if len(link) + len(title_short) + len(tag) + len(tags) + 2 < (140):
-            if len(tags) == 0: tags = tag
-            else: tags = " ".join([tags, tag])
+class Template(object):
+    """ A tweet layout compiled for repeated rendering.
+
+    Layouts are str.format strings using {title}, {link} and {tags}. The
+    length of the literal text and how often each field appears are worked
+    out once here, so rendering only has to fit the title and tags.
+    """
+
+    def __init__(self, template):
+        counts = dict((field, 0) for field in FIELDS)
+        for literal, field, spec, conversion in Formatter().parse(template):
+            if field is None: continue
+            if field not in counts:
+                raise ValueError("Unknown template field '{0}'. Use {1}".format(field, ", ".join(FIELDS)))
+
+            ## Padding or conversions change a field's length after it is fitted
+            if spec or conversion:
+                raise ValueError("Template field '{0}' can't have a format spec or conversion".format(field))
+            counts[field] += 1
+
+        self.template = template
+        self._format = template.format
+        self._fixed = len(template.format(title="", link="", tags=""))
+        self._titles = counts['title']
+        self._links = counts['link']
+        self._tags = counts['tags']
+
+    def __call__(self, item, config):
+        """ Render an atom.
+
+        Tags are fitted against the first format.title_split characters of
+        the title, then the title gets whatever room is left and is cut with
+        "..." if it is longer. The link counts as format.link_weight
+        characters if that is set, the way t.co wraps every link to a fixed
+        length.
+        """
+        link = item['short_link']
+        title = item['title']
+
+        ## Room for the titles and tags once the literal text and links are in
+        budget = config.format.tweet_length - self._fixed - self._links * (config.format.link_weight or len(link))
+
+        head = min(len(title), config.format.title_split) * self._titles
+        tags = []
+        tags_len = 0
+        if self._tags:
+            for tag in item['tags']:
+                cost = (len(tag) + (1 if tags else 0)) * self._tags
+                if head + tags_len + cost <= budget:
+                    tags.append(tag)
+                    tags_len += cost
 
-    while len(link) + len(title_short) + len(tag) + len(tags) + 2 < (140) and len(title_ext) > 0:
-        title_short += title_ext[:1]
-        title_ext = title_ext[1:]
+        if self._titles:
+            room = (budget - tags_len) // self._titles
+            if len(title) > room:
+                title = "".join([title[:max(room - 3, 0)].strip(), "..."])
 
-    if len(title_ext) > 0:
-        title_short = "".join([title_short[:-3].strip(), "..."])
+        return self._format(title=title, link=link, tags=" ".join(tags))
+
+
+_templates = {}
+_templates_lock = Lock()
+
+
+def get_template(feed_id, template=None):
+    """ Get the compiled template for a feed, compiling it on first use.
+
+    The cache is keyed by feed id and recompiles if the feed's template
+    text changes.
+    """
+    template = template or DEFAULT_TEMPLATE
+    compiled = _templates.get(feed_id)
+    if compiled and compiled.template == template:
+        return compiled
+
+    compiled = Template(template)
+    with _templates_lock:
+        _templates[feed_id] = compiled
+    return compiled
+
+
+def format_atom(item, config):
+    """ Compose the tweet for an atom with its feed's template """
+    #calais = Calais(config.calais_keys.key)
+    #r = calais.analyze_url(i['link'])
+    return get_template(item.get('feed_id'), item.get('template'))(item, config)
 
-    return "{0}\n{1}\n{2}".format(title_short, link, tags)
 
+def format_many(items, config):
+    """ Compose the tweets for many atoms """
+    return [format_atom(item, config) for item in items]
@@ -0,0 +1,237 @@
+from threading import Lock
+from urlparse import urlsplit, urljoin
+from time import time
+import httplib
+import socket
+import zlib
+
+_REDIRECTS = (301, 302, 303, 307, 308)
+_CHUNK = 65536
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+class HttpError(Exception):
+    """ A response with a status the caller can not use """
+
+    def __init__(self, status, url):
+        Exception.__init__(self, "HTTP {0} from {1}".format(status, url))
+        self.status = status
+        self.url = url
+
+
+class Response(object):
+    """ A fully read HTTP response """
+
+    def __init__(self, url):
+        self.url = url
+        self.status = None
+        self.headers = {}
+        self.body = ""
+        self.bytes = 0
+        self.connect_time = 0.0
+        self.transfer_time = 0.0
+
+    def __repr__(self):
+        return "<Response url({0}), status({1}), bytes({2}), connect({3:.3f}), transfer({4:.3f})>".format(
+            self.url,
+            self.status,
+            self.bytes,
+            self.connect_time,
+            self.transfer_time,
+        )
+
+
+class HttpClient(object):
+    """ HTTP GET client with keep-alive connection pooling per host.
+
+    Asks for gzip/deflate and decompresses the body, follows redirects and
+    refuses bodies over max_body bytes, before or after decompression.
+    """
+
+    def __init__(self, max_per_host=2, timeout=20, max_body=10*1024*1024, max_redirects=5, user_agent=None):
+        self._max_per_host = max_per_host
+        self._timeout = timeout
+        self._max_body = max_body
+        self._max_redirects = max_redirects
+        self._user_agent = user_agent
+        self._idle = {}
+        self._lock = Lock()
+
+    def _checkout(self, key, timeout):
+        """ Returns (connection, reused) """
+        with self._lock:
+            idle = self._idle.get(key)
+            con = idle.pop() if idle else None
+        if con:
+            con.sock.settimeout(timeout)
+            return con, True
+
+        scheme, host, port = key
+        cls = httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection
+        return cls(host, port, timeout=timeout), False
+
+    def _checkin(self, key, con):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self._max_per_host:
+                idle.append(con)
+                return
+        con.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for cons in idle.values():
+            for con in cons:
+                con.close()
+
+    def get(self, url, headers=None, timeout=None, max_body=None):
+        """ GET url, following redirects.
+
+        Returns:
+            a Response. Connect and transfer times and bytes on the wire are
+            summed over any redirects.
+        """
+        timeout = timeout or self._timeout
+        max_body = max_body or self._max_body
+        total = Response(url)
+
+        for n in range(self._max_redirects + 1):
+            response = self._request(url, headers or {}, timeout, max_body)
+            total.bytes += response.bytes
+            total.connect_time += response.connect_time
+            total.transfer_time += response.transfer_time
+
+            location = response.headers.get('location')
+            if response.status not in _REDIRECTS or not location:
+                response.bytes = total.bytes
+                response.connect_time = total.connect_time
+                response.transfer_time = total.transfer_time
+                return response
+            url = urljoin(url, location)
+
+        raise httplib.HTTPException("Too many redirects for {0}".format(total.url))
+
+    def _request(self, url, headers, timeout, max_body):
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == "https" else 80)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or "/"
+        if parts.query: path = "{0}?{1}".format(path, parts.query)
+
+        request_headers = {'Accept-Encoding': "gzip, deflate"}
+        if self._user_agent: request_headers['User-Agent'] = self._user_agent
+        request_headers.update(headers)
+
+        ## A pooled connection may have been closed by the server while idle,
+        ## so a failure on one is retried once on a fresh connection.
+        for attempt in range(2):
+            con, reused = self._checkout(key, timeout)
+            response = Response(url)
+            try:
+                if not reused:
+                    start = time()
+                    con.connect()
+                    response.connect_time = time() - start
+
+                start = time()
+                con.request("GET", path, headers=request_headers)
+                raw = con.getresponse()
+                self._read(raw, response, max_body)
+                response.transfer_time = time() - start
+            except (httplib.HTTPException, socket.error):
+                con.close()
+                if reused and attempt == 0: continue
+                raise
+            except:
+                con.close()
+                raise
+
+            if raw.will_close: con.close()
+            else: self._checkin(key, con)
+            return response
+
+    def _read(self, raw, response, max_body):
+        response.status = raw.status
+        response.headers = dict((k.lower(), v) for k,v in raw.getheaders())
+
+        encoding = response.headers.get('content-encoding', '').lower()
+        if encoding == "gzip":
+            decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            decoder = _DeflateDecoder()
+        else:
+            decoder = None
+
+        chunks = []
+        size = 0
+        while True:
+            data = raw.read(_CHUNK)
+            if not data: break
+            response.bytes += len(data)
+
+            ## Inflate at most one byte past the cap so a small gzip bomb
+            ## can not expand in memory before it is refused
+            while data:
+                if decoder:
+                    chunk = decoder.decompress(data, max_body + 1 - size)
+                    data = decoder.unconsumed_tail
+                else:
+                    chunk, data = data, None
+                size += len(chunk)
+                if response.bytes > max_body or size > max_body:
+                    raise BodyTooLarge("Body of {0} is larger than {1} bytes".format(response.url, max_body))
+                chunks.append(chunk)
+
+        if decoder: chunks.append(decoder.flush())
+        response.body = "".join(chunks)
+
+        ## Only the decompressed body is handed on
+        response.headers.pop('content-encoding', None)
+
+
+class _DeflateDecoder(object):
+    """ 'deflate' is sent both zlib wrapped and raw, so try both """
+
+    def __init__(self):
+        self._decoder = None
+
+    def decompress(self, data, max_length):
+        if self._decoder is None:
+            self._decoder = zlib.decompressobj()
+            try:
+                return self._decoder.decompress(data, max_length)
+            except zlib.error:
+                self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decoder.decompress(data, max_length)
+
+    @property
+    def unconsumed_tail(self):
+        return self._decoder.unconsumed_tail if self._decoder else ""
+
+    def flush(self):
+        return self._decoder.flush() if self._decoder else ""
+
+
+_client = None
+_client_lock = Lock()
+
+def configure(**kwargs):
+    """ Replace the shared client. Takes the HttpClient arguments """
+    global _client
+    with _client_lock:
+        old, _client = _client, HttpClient(**kwargs)
+    if old: old.close()
+    return _client
+
+def get_client():
+    """ The client shared by every feed fetch, so connections are reused across feeds """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient()
+        return _client
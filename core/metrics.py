@@ -0,0 +1,250 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from collections import OrderedDict
+from threading import Thread, Lock
+from bisect import bisect_left
+from time import sleep
+from stopwatch import now, now_ns
+
+## Upper bounds in seconds. Covers formatting one atom up to a tweet that waited a week
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600, 4*3600,
+                   12*3600, 24*3600, 7*24*3600)
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs: return ""
+    return "{" + ",".join('{0}="{1}"'.format(k, v) for k, v in pairs) + "}"
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+        self._lock = Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Gauge(object):
+    """ A value that is set, or read from fn when exported """
+
+    def __init__(self, fn=None):
+        self._fn = fn
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    @property
+    def value(self):
+        if self._fn:
+            try:
+                return self._fn()
+            except Exception:
+                return 0
+        return self._value
+
+
+class Histogram(object):
+    """ Counts of observations per bucket, with the sum for the mean """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def percentile(self, pct):
+        """ The upper bound of the bucket holding the pct observation """
+        with self._lock:
+            counts, count = list(self.counts), self.count
+        if not count: return 0.0
+        rank = pct * count
+        seen = 0
+        for n, c in enumerate(counts):
+            seen += c
+            if seen >= rank and c:
+                return self.buckets[n] if n < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+class _Timer(object):
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = now_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = (now_ns() - self._start) / 1e9
+        self._histogram.observe(self.elapsed)
+        return False
+
+
+class Registry(object):
+    """ Named metrics with optional labels.
+
+    Asking for the same name and labels twice returns the same metric, so
+    stages can look metrics up where they use them.
+    """
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._lock = Lock()
+
+    def _get(self, cls, name, labels, *args):
+        key = _key(name, labels)
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = self._metrics[key] = cls(*args)
+            return metric
+
+    def counter(self, name, **labels):
+        return self._get(Counter, name, labels)
+
+    def gauge(self, name, fn=None, **labels):
+        gauge = self._get(Gauge, name, labels, fn)
+        if fn: gauge._fn = fn
+        return gauge
+
+    def histogram(self, name, **labels):
+        return self._get(Histogram, name, labels)
+
+    def items(self):
+        with self._lock:
+            return list(self._metrics.items())
+
+    def render(self):
+        """ The metrics in the Prometheus text format """
+        lines = []
+        for (name, labels), metric in self.items():
+            if isinstance(metric, Histogram):
+                seen = 0
+                for bound, count in zip(metric.buckets + ("+Inf",), metric.counts):
+                    seen += count
+                    lines.append("{0}_bucket{1} {2}".format(name, _format_labels(labels, [("le", bound)]), seen))
+                lines.append("{0}_sum{1} {2}".format(name, _format_labels(labels), metric.sum))
+                lines.append("{0}_count{1} {2}".format(name, _format_labels(labels), metric.count))
+            else:
+                lines.append("{0}{1} {2}".format(name, _format_labels(labels), metric.value))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """ One line with every counter and gauge and the p50/p99 of every histogram """
+        parts = []
+        for (name, labels), metric in self.items():
+            label = name + _format_labels(labels)
+            if isinstance(metric, Histogram):
+                if not metric.count: continue
+                parts.append("{0}=n:{1},p50:{2},p99:{3}".format(label, metric.count, metric.percentile(0.5), metric.percentile(0.99)))
+            else:
+                parts.append("{0}={1}".format(label, metric.value))
+        return " ".join(parts)
+
+
+class AtomTracker(object):
+    """ Time atoms spend in each status.
+
+    Every move observes `atom_status_seconds{status=<old>}`. Reaching one of
+    the final statuses, or passing a milestone, also observes
+    `atom_total_seconds{status=<new>}` from the time the atom was received.
+    At most max_atoms are followed at once.
+    """
+
+    def __init__(self, registry, final=("SENT", "DROPPED"), milestones=("WAIT",), max_atoms=100000):
+        self._registry = registry
+        self._final = final
+        self._milestones = milestones
+        self._max_atoms = max_atoms
+        self._atoms = OrderedDict()
+        self._lock = Lock()
+
+    def received(self, ident, status="RECIEVED", when=None):
+        if when is None: when = now()
+        with self._lock:
+            self._atoms[ident] = (status, when, when)
+            while len(self._atoms) > self._max_atoms:
+                self._atoms.popitem(last=False)
+
+    def transition(self, ident, status, when=None):
+        """ Returns:
+            The seconds since ident was received, or None if it isn't followed
+        """
+        if when is None: when = now()
+        with self._lock:
+            entry = self._atoms.pop(ident, None)
+            if entry and status not in self._final:
+                self._atoms[ident] = (status, when, entry[2])
+        if not entry: return None
+
+        old, since, received = entry
+        self._registry.histogram("atom_status_seconds", status=old).observe(when - since)
+        if status in self._final or status in self._milestones:
+            self._registry.histogram("atom_total_seconds", status=status).observe(when - received)
+        return when - received
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(registry, port, bind="127.0.0.1"):
+    """ Export registry at http://bind:port/metrics on a daemon thread """
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = _Server((bind, port), _Handler)
+    thread = Thread(name="metricsThread", target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def log_periodically(registry, delta, prefix="METRICS"):
+    """ Print registry.summary() every delta seconds on a daemon thread """
+    def _run():
+        while True:
+            sleep(delta)
+            print("{0}: {1}".format(prefix, registry.summary()))
+
+    thread = Thread(name="metricsLogThread", target=_run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+## The registry and tracker the pipeline reports to
+registry = Registry()
+atoms = AtomTracker(registry)
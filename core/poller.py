@@ -0,0 +1,88 @@
+import heapq
+
+
+class PollPlanner(object):
+    """ Decide when each feed should be fetched next.
+
+    A feed's base interval is the median gap between its recent publish
+    times, bounded by min_delta and max_delta. Polls that find nothing new,
+    or fail, stretch the interval by backoff until something new shows up.
+    """
+
+    def __init__(self, min_delta, max_delta, default_delta, backoff=2.0):
+        self._min = min_delta
+        self._max = max(max_delta, min_delta)
+        self._default = default_delta
+        self._backoff = backoff
+        self._heap = []
+        self._next = {}
+        self._base = {}
+        self._factor = {}
+
+    def _clamp(self, delta):
+        return min(max(delta, self._min), self._max)
+
+    def interval(self, publish_dts):
+        """ The base poll interval for a feed with the given publish times """
+        stamps = sorted(set(ts for ts in publish_dts if ts))
+        if len(stamps) < 2:
+            return self._clamp(self._default)
+
+        gaps = sorted(b - a for a,b in zip(stamps, stamps[1:]))
+        return self._clamp(gaps[len(gaps) // 2])
+
+    def schedule(self, feed_id, at):
+        self._next[feed_id] = at
+        heapq.heappush(self._heap, (at, feed_id))
+
+    def sync(self, feed_ids, now):
+        """ Start polling new feeds right away and forget removed ones """
+        feed_ids = set(feed_ids)
+        for feed_id in list(self._next):
+            if feed_id not in feed_ids:
+                del self._next[feed_id]
+                self._base.pop(feed_id, None)
+                self._factor.pop(feed_id, None)
+        for feed_id in feed_ids:
+            if feed_id not in self._next:
+                self.schedule(feed_id, now)
+
+    def due(self, now):
+        """ Pop every feed whose poll time has come """
+        feed_ids = []
+        while self._heap and self._heap[0][0] <= now:
+            at, feed_id = heapq.heappop(self._heap)
+
+            ## Skip entries that were rescheduled or removed
+            if self._next.get(feed_id) != at: continue
+            del self._next[feed_id]
+            feed_ids.append(feed_id)
+        return feed_ids
+
+    def wait(self, now):
+        """ Seconds until the next feed is due, or None if nothing is planned """
+        while self._heap and self._next.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if not self._heap: return None
+        return max(self._heap[0][0] - now, 0)
+
+    def reschedule(self, feed_id, now, publish_dts=None, changed=True, error=False):
+        """ Plan the next poll after a fetch.
+
+        Arguments:
+            publish_dts - Recent publish timestamps for the feed, if known
+            changed - False if the fetch found nothing new
+            error - True if the fetch failed
+        """
+        if publish_dts is not None:
+            self._base[feed_id] = self.interval(publish_dts)
+        base = self._base.get(feed_id, self._clamp(self._default))
+
+        if changed and not error:
+            self._factor[feed_id] = 1.0
+        else:
+            self._factor[feed_id] = min(self._factor.get(feed_id, 1.0) * self._backoff, float(self._max) / base)
+
+        delta = self._clamp(int(base * self._factor[feed_id]))
+        self.schedule(feed_id, now + delta)
+        return delta
@@ -0,0 +1,255 @@
+from threading import Thread, Lock, Condition
+from collections import deque
+from Queue import Queue, Empty, Full
+from time import time, sleep
+import cPickle as pickle
+import sqlite3
+
+
+class MemoryQueue(Queue):
+    """ In-memory stage queue. Nothing survives a restart.
+
+    With clock, get() and put() block and time out on that clock.
+    """
+
+    def __init__(self, maxsize=0, clock=None):
+        Queue.__init__(self, maxsize)
+        self._clock = clock
+        if clock:
+            self.not_empty = clock.condition(self.mutex)
+            self.not_full = clock.condition(self.mutex)
+            self.all_tasks_done = clock.condition(self.mutex)
+
+    def _wait(self, cond, ready, block, timeout, error):
+        if ready(): return
+        if not block: raise error
+        deadline = None if timeout is None else self._clock.time() + timeout
+        while not ready():
+            remaining = None if deadline is None else deadline - self._clock.time()
+            if remaining is not None and remaining <= 0: raise error
+            cond.wait(remaining)
+
+    def put(self, item, block=True, timeout=None):
+        if not self._clock: return Queue.put(self, item, block, timeout)
+        with self.not_full:
+            self._wait(self.not_full, lambda: self.maxsize <= 0 or self._qsize() < self.maxsize, block, timeout, Full)
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        if not self._clock: return Queue.get(self, block, timeout)
+        with self.not_empty:
+            self._wait(self.not_empty, self._qsize, block, timeout, Empty)
+            item = self._get()
+            self.not_full.notify()
+            return item
+
+    def ack(self, key):
+        pass
+
+
+class QueueStore(object):
+    """ SQLite file backing the durable queues of one pipeline.
+
+    Every item is one row keyed by the atom's uniq_id. Putting an item on the
+    next stage's queue moves the row, so an atom is only ever in one queue.
+    The database runs in WAL mode with synchronous=NORMAL, which batches
+    fsyncs to checkpoints.
+
+    The queues work on an in-memory mirror of the table, so get() never
+    touches the database. Puts and deletes go to a log that a writer thread
+    drains. Each drain writes the latest row of every key it holds, with
+    executemany, in one transaction. A crashed process can lose the last
+    drain, a few milliseconds of moves and acks. Those atoms are handed out
+    again from the queue they were in, so none is lost.
+    """
+
+    def __init__(self, path):
+        self._con = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute("PRAGMA synchronous=NORMAL")
+        self._con.execute("CREATE TABLE IF NOT EXISTS item ("
+                          "key TEXT PRIMARY KEY, queue TEXT NOT NULL, seq INTEGER NOT NULL, "
+                          "ready INTEGER NOT NULL, payload BLOB NOT NULL)")
+        self._con.execute("CREATE INDEX IF NOT EXISTS item_queue ON item (queue, ready, seq)")
+        lock = Lock()
+        self.cond = Condition(lock)
+        self._dirty = Condition(lock)
+        self._synced = Condition(lock)
+        self._seq = (self._con.execute("SELECT MAX(seq) FROM item").fetchone()[0] or 0) + 1
+        self._load()
+
+        ## key -> row to store, or None to delete. _logged counts log changes
+        ## and _written how many of them are committed
+        self._log = {}
+        self._logged = 0
+        self._written = 0
+        self._running = True
+        self._writer = Thread(name="queueStoreThread", target=self._write)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def _load(self):
+        ## Every stored item is ready when the store is opened. Taken items
+        ## are only tracked in memory
+        self.items = {}
+        self.ready = {}
+        self.payloads = {}
+        for key, queue, payload in self._con.execute("SELECT key, queue, payload FROM item ORDER BY seq"):
+            self.items[key] = queue
+            self.ready.setdefault(queue, deque()).append(key)
+            self.payloads[key] = pickle.loads(str(payload))
+
+    def _write(self):
+        while True:
+            with self.cond:
+                while self._running and not self._log:
+                    self._dirty.wait()
+                if not self._log: return
+                log, self._log = self._log, {}
+                logged = self._logged
+
+            try:
+                self._con.execute("BEGIN")
+                self._con.executemany("DELETE FROM item WHERE key = ?",
+                                      [(key,) for key, row in log.iteritems() if row is None])
+                self._con.executemany("INSERT OR REPLACE INTO item (key, queue, seq, ready, payload) VALUES (?, ?, ?, 1, ?)",
+                                      [row for row in log.itervalues() if row is not None])
+                self._con.execute("COMMIT")
+            except Exception as e:
+                print("QUEUES: Write failed, retrying: {0}".format(e))
+                try:
+                    self._con.execute("ROLLBACK")
+                except sqlite3.Error:
+                    pass
+                with self.cond:
+                    log.update(self._log)
+                    self._log = log
+                sleep(1)
+                continue
+
+            with self.cond:
+                self._written = logged
+                self._synced.notify_all()
+
+    def log(self, key, row=None):
+        """ Store row for key, or delete key's row. The caller must hold cond """
+        self._log[key] = row
+        self._logged += 1
+        self._dirty.notify()
+
+    def sync(self):
+        """ Wait for everything logged so far to be committed. The caller must hold cond """
+        logged = self._logged
+        while self._written < logged:
+            self._synced.wait()
+
+    def forget(self, key):
+        """ Remove the row for key if there is one. The caller must hold cond """
+        queue = self.items.pop(key, None)
+        if queue is None: return
+        if self.payloads.pop(key, None) is not None: self.ready[queue].remove(key)
+        self.log(key)
+
+    def next_seq(self):
+        seq = self._seq
+        self._seq += 1
+        return seq
+
+    def recover(self):
+        """ Make every stored item available again, taken or not.
+
+        Returns:
+            The number of items in the store.
+        """
+        with self.cond:
+            self.sync()
+            self._load()
+            self.cond.notify_all()
+            return len(self.items)
+
+    def keys(self):
+        with self.cond:
+            return set(self.items)
+
+    def close(self):
+        with self.cond:
+            self._running = False
+            self._dirty.notify()
+        self._writer.join()
+        self._con.close()
+
+
+class DurableQueue(object):
+    """ Stage queue persisted in a QueueStore.
+
+    Has the put/get/empty/qsize interface of Queue.Queue. An item taken with
+    get() stays in the store until it is put on another queue or ack()ed,
+    and is handed out again by QueueStore.recover() after a crash.
+    """
+
+    def __init__(self, store, name, key, maxsize=0):
+        self._store = store
+        self._name = name
+        self._key = key
+        self.maxsize = maxsize
+
+    def _qsize(self):
+        return len(self._store.ready.get(self._name, ()))
+
+    def _wait(self, deadline, error):
+        if deadline is None:
+            self._store.cond.wait()
+            return
+        remaining = deadline - time()
+        if remaining <= 0: raise error
+        self._store.cond.wait(remaining)
+
+    def qsize(self):
+        with self._store.cond:
+            return self._qsize()
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def put(self, item, block=True, timeout=None):
+        deadline = None if timeout is None else time() + timeout
+        payload = sqlite3.Binary(pickle.dumps(item, pickle.HIGHEST_PROTOCOL))
+
+        with self._store.cond:
+            while self.maxsize > 0 and self._qsize() >= self.maxsize:
+                if not block: raise Full
+                self._wait(deadline, Full)
+
+            ## Replacing the row moves the item in one write
+            key = self._key(item)
+            store = self._store
+            if store.payloads.pop(key, None) is not None: store.ready[store.items[key]].remove(key)
+            store.items[key] = self._name
+            store.ready.setdefault(self._name, deque()).append(key)
+            store.payloads[key] = item
+            store.log(key, (key, self._name, store.next_seq(), payload))
+            store.cond.notify_all()
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else time() + timeout
+
+        with self._store.cond:
+            while not self._qsize():
+                if not block: raise Empty
+                self._wait(deadline, Empty)
+
+            key = self._store.ready[self._name].popleft()
+            item = self._store.payloads.pop(key)
+            self._store.cond.notify_all()
+
+        return item
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def ack(self, key):
+        """ The item is finished with and can be forgotten """
+        with self._store.cond:
+            self._store.forget(key)
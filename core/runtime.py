@@ -0,0 +1,54 @@
+from os.path import abspath
+import sys
+import os
+
+THREADS = "threads"
+GEVENT = "gevent"
+RUNTIMES = (THREADS, GEVENT)
+
+## Patch first, then run the script the way `python script.py` would
+_GEVENT_BOOTSTRAP = """
+from gevent import monkey; monkey.patch_all()
+from os.path import dirname
+import runpy, sys
+sys.argv.pop(0)
+sys.path[0] = dirname(sys.argv[0])
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+
+def _patched():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("socket")
+
+
+def active():
+    """ The runtime this process is running under """
+    return GEVENT if _patched() else THREADS
+
+
+def ensure(name, argv):
+    """ Make sure the process runs under the named runtime.
+
+    The stage functions are the same for both. Under gevent they run as
+    greenlets on one OS thread, and every socket, sleep, select and queue
+    wait yields to the others, so a fetch pool can be hundreds wide.
+
+    gevent has to patch the standard library before anything imports it, so
+    switching re-executes the script with the same arguments after patching.
+    This does not return in that case.
+    """
+    if name not in RUNTIMES:
+        raise ValueError("Unknown runtime '{0}'".format(name))
+    if name == THREADS or _patched(): return
+
+    try:
+        import gevent
+    except ImportError:
+        raise ImportError("The gevent runtime needs the gevent package installed")
+
+    sys.stdout.flush()
+    os.execv(sys.executable, [sys.executable, "-c", _GEVENT_BOOTSTRAP, abspath(argv[0])] + list(argv[1:]))
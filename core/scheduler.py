@@ -1,24 +1,125 @@
+from collections import deque
+from heapq import heappush, heappop
 import time
 
+DAY = 24*60*60
+WEEK = 7*DAY
+
+
 class Scheduler(object):
     def __init__(self, conf):
 
-        self._schedules = []
+        self._count = conf.tweet_quota.count
+
+        ## Windows are kept as (seconds after the start of the period, duration).
+        ## The static windows repeat daily.
+        self._static = []
         for window_start in conf.schedule.window_start:
-            self._schedules.append((window_start, conf.schedule.window_duration))
+            offset = window_start.tm_hour * 3600 + window_start.tm_min * 60 + window_start.tm_sec
+            self._static.append((offset, conf.schedule.window_duration))
+        self.use_windows(self._static, DAY)
+
+    def use_windows(self, windows, period=DAY):
+        """ Switch to a new set of (offset, duration) windows repeating every period """
+        ## One assignment, so a plan running on another thread never pairs
+        ## the new windows with the old period
+        self._layout = (sorted(windows), period)
+
+    def use_static(self):
+        self.use_windows(self._static, DAY)
+
+    @staticmethod
+    def _period_start(ts, period):
+        day = time.localtime(ts)
+        midnight = int(time.mktime(time.struct_time(day[:3] + (0, 0, 0) + day[6:8] + (-1,))))
+        if period == WEEK:
+            midnight -= day.tm_wday * DAY
+        return midnight
+
+    def _windows(self, seed, layout):
+        """ Yield (window_start, window_duration) for every window after seed, in order.
+
+        A window is only used if it starts after the previous one ended.
+        """
+        schedules, period = layout
+        start = self._period_start(seed, period)
+        while True:
+            for offset, window_duration in schedules:
+                window_start = start + offset
+                if window_start > seed:
+                    yield window_start, window_duration
+                    seed = window_start + window_duration
+            start += period
+
+            ## Jump straight to the period the next window can start in
+            if seed > start + period:
+                start += ((seed - start) // period) * period
 
     def get_next_schedule(self, seed):
-        today = time.localtime()
-        real_schedules = []
+        """ The first (window_start, window_duration) after seed, or None if there are no windows """
+        layout = self._layout
+        if not layout[0]: return None
+        for window in self._windows(seed, layout):
+            return window
+
+    def plan(self, seed, count):
+        """ Plan the tweet slots following seed.
+
+        Whole windows are planned until there are at least count slots.
+        Each window holds tweet_quota.count evenly spaced slots.
+
+        Returns:
+            a tuple (slots, seed)
+            slots is a deque of timestamps in order and seed is the end of
+            the last planned window, to pass to the next call.
+        """
+        slots = deque()
+        layout = self._layout
+        if not layout[0]: return slots, seed
+
+        for window_start, window_duration in self._windows(seed, layout):
+            step = max(window_duration // self._count, 1)
+            slots.extend(range(window_start, window_start + window_duration, step))
+            seed = window_start + window_duration
+            if len(slots) >= count: break
+
+        return slots, seed
+
+    @staticmethod
+    def assign(atoms, slots, now, expire_delta):
+        """ Match waiting atoms to slots, earliest deadline first.
+
+        An atom's deadline is its recv time plus expire_delta. Filling each
+        slot in time order with the waiting atom closest to its deadline
+        sends as many atoms as possible before they expire.
+
+        Arguments:
+            atoms - The waiting atoms (dicts with 'recv')
+            slots - A deque of slot timestamps in order. Used slots and slots
+                    that are already past are removed from it.
+            now - The current timestamp
+            expire_delta - How long an atom may wait to be sent
 
-        for window_start, window_duration in self._schedules:
-            real_window_start = int(time.mktime(time.struct_time(today[:3] + window_start[3:])))
+        Returns:
+            a tuple (assigned, dropped, waiting)
+            assigned is a list of (slot, atom), dropped the atoms that expired
+            and waiting the atoms left over once the slots ran out.
+        """
+        heap = []
+        for n, atom in enumerate(atoms):
+            heappush(heap, (atom['recv'] + expire_delta, n, atom))
 
-            while seed > real_window_start:
-                real_window_start += (24*60*60)
+        while slots and slots[0] <= now:
+            slots.popleft()
 
-            real_schedules.append((real_window_start, window_duration))
+        assigned = []
+        dropped = []
+        while heap and slots:
+            slot = slots[0]
+            deadline, n, atom = heappop(heap)
+            if deadline < slot:
+                dropped.append(atom)
+                continue
+            assigned.append((slots.popleft(), atom))
 
-        for window_start, window_duration in sorted(real_schedules):
-            if window_start > seed:
-                return window_start, window_duration
+        return assigned, dropped, [atom for deadline, n, atom in sorted(heap)]
@@ -0,0 +1,297 @@
+from collections import OrderedDict, deque
+from threading import Lock, Event
+from Queue import Queue, Empty
+from urllib import urlencode
+from time import sleep
+from stopwatch import now
+from clock import SystemClock
+from queues import MemoryQueue
+import hashlib
+import random
+import urllib2
+import json
+import bitly_api
+import metrics
+import db
+
+
+class BitlyShortener(object):
+    """ Shorten links with the bit.ly API """
+
+    def __init__(self, user, key):
+        self._bitly = bitly_api.Connection(user, access_token=key)
+
+    def shorten(self, link):
+        result = self._bitly.shorten(link)
+        if not result: return None
+        return result['url']
+
+
+class HttpShortener(object):
+    """ Shorten links with any service speaking the bit.ly v3 shorten call.
+
+    Used to point the bot at a local stand-in for tests and benchmarks.
+    """
+
+    def __init__(self, endpoint, key, timeout=20):
+        self._endpoint = endpoint.rstrip("/")
+        self._key = key
+        self._timeout = timeout
+
+    def shorten(self, link):
+        query = urlencode({'access_token': self._key, 'longUrl': link})
+        response = urllib2.urlopen("{0}/v3/shorten?{1}".format(self._endpoint, query), timeout=self._timeout)
+        try:
+            result = json.load(response)
+        finally:
+            response.close()
+
+        if result.get('status_code') != 200: return None
+        return result['data']['url']
+
+
+class TokenBucket(object):
+    """ Allow `rate` calls per second on average with bursts of up to `burst` """
+
+    def __init__(self, rate, burst):
+        self._rate = float(rate)
+        self._burst = float(max(burst, 1))
+        self._tokens = self._burst
+        self._stamp = now()
+        self._lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                stamp = now()
+                self._tokens = min(self._burst, self._tokens + (stamp - self._stamp) * self._rate)
+                self._stamp = stamp
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            sleep(wait)
+
+
+class RateLimitedShortener(object):
+    """ Hold calls to a shortener to the provider's quota """
+
+    def __init__(self, shortener, bucket):
+        self._shortener = shortener
+        self._bucket = bucket
+
+    def shorten(self, link):
+        self._bucket.acquire()
+        return self._shortener.shorten(link)
+
+
+def from_config(config, shares=1):
+    """ Build the shortener selected by the [BITLY_KEYS] section.
+
+    shares splits the quota between that many processes using the same key.
+    """
+    if config.bitly_keys.endpoint:
+        shortener = HttpShortener(config.bitly_keys.endpoint, config.bitly_keys.key)
+    else:
+        shortener = BitlyShortener(config.bitly_keys.user, config.bitly_keys.key)
+
+    bucket = TokenBucket(config.bitly_keys.rate_limit / 60.0 / shares, max(config.bitly_keys.rate_burst // shares, 1))
+    return RateLimitedShortener(shortener, bucket)
+
+
+class _Pending(object):
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class ShortLinkCache(object):
+    """ Remember short links so a link is only sent to the shortener once.
+
+    Lookups go to an in-memory LRU with a TTL first, then to the short link
+    recorded for the same link hash by any account, and only then to the
+    shortener.
+    Concurrent requests for the same link share one shortener call.
+    """
+
+    def __init__(self, shortener, dbschema=None, max_size=1024, ttl=86400):
+        self._shortener = shortener
+        self._dbschema = dbschema
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = Lock()
+        self.stats = {
+            'hits': 0,
+            'db_hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+        }
+
+    def _get(self, link):
+        entry = self._entries.pop(link, None)
+        if not entry: return None
+        short_link, expires = entry
+        if expires < now(): return None
+
+        ## Reinsert to mark it most recently used
+        self._entries[link] = entry
+        return short_link
+
+    def _put(self, link, short_link):
+        self._entries.pop(link, None)
+        self._entries[link] = (short_link, now() + self._ttl)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def _lookup(self, link):
+        if not self._dbschema: return None
+        uid = hashlib.md5(link).hexdigest()
+        session = db.Session(self._dbschema)
+        try:
+            row = session.query(db.Atom.bitly).filter(
+                db.Atom.uniq_id == uid,
+                db.Atom.bitly != None).first()
+
+            ## Accounts record their short links per account
+            if not row:
+                row = session.query(db.AccountAtom.bitly).filter(
+                    db.AccountAtom.atom_uniq_id == uid,
+                    db.AccountAtom.bitly != None).first()
+        finally:
+            session.close()
+        return row[0] if row else None
+
+    def shorten(self, link):
+        with self._lock:
+            short_link = self._get(link)
+            if short_link:
+                self.stats['hits'] += 1
+                return short_link
+
+            pending = self._pending.get(link)
+            owner = pending is None
+            if owner:
+                pending = self._pending[link] = _Pending()
+            else:
+                self.stats['coalesced'] += 1
+
+        if not owner:
+            pending.done.wait()
+            if pending.error: raise pending.error
+            return pending.result
+
+        source = 'db_hits'
+        try:
+            short_link = self._lookup(link)
+            if not short_link:
+                source = 'misses'
+                short_link = self._shortener.shorten(link)
+            pending.result = short_link
+        except Exception as e:
+            pending.error = e
+            raise
+        finally:
+            with self._lock:
+                self.stats[source] += 1
+                if pending.result: self._put(link, pending.result)
+                del self._pending[link]
+            pending.done.set()
+
+        return short_link
+
+
+def _percentile(samples, pct):
+    if not samples: return 0.0
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * pct), len(ordered) - 1)]
+
+
+class ShortenerPool(object):
+    """ Shorten links on a bounded set of worker threads.
+
+    Failed calls are retried with jittered exponential backoff. Finished
+    work is collected with completed() as (key, short_link) pairs, where
+    short_link is None if every attempt failed.
+
+    With clock, the workers are started and wait for jobs through it. On a
+    SimulatedClock a call in progress then holds time still.
+    """
+
+    def __init__(self, shortener, workers=4, retries=3, backoff=1.0, samples=1000, clock=None):
+        self._shortener = shortener
+        self._retries = retries
+        self._backoff = backoff
+        self._jobs = MemoryQueue(clock=clock)
+        self._done = Queue()
+        self._lock = Lock()
+        self._in_flight = 0
+        self._waits = deque(maxlen=samples)
+        self._latencies = deque(maxlen=samples)
+        self._clock = clock or SystemClock()
+        self._threads = [self._clock.spawn("shortenThread{0}".format(n), self._run, daemon=True)
+                         for n in range(max(workers, 1))]
+
+    def _shorten(self, link):
+        for attempt in range(self._retries + 1):
+            try:
+                return self._shortener.shorten(link)
+            except Exception as e:
+                if attempt == self._retries:
+                    print("SHORTENER: Giving up on {0}: {1}".format(link, e))
+                    return None
+                self._clock.sleep(self._backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None: return
+            key, link, submitted = job
+
+            start = now()
+            short_link = self._shorten(link)
+            end = now()
+
+            metrics.registry.histogram("shorten_seconds").observe(end - start)
+            with self._lock:
+                self._in_flight -= 1
+                self._waits.append(start - submitted)
+                self._latencies.append(end - start)
+            self._done.put((key, short_link))
+
+    def submit(self, key, link):
+        with self._lock:
+            self._in_flight += 1
+        self._jobs.put((key, link, now()))
+
+    def completed(self, timeout=0):
+        """ Collect finished work, waiting up to timeout for the first one """
+        results = []
+        try:
+            results.append(self._done.get(timeout=timeout) if timeout else self._done.get_nowait())
+            while True:
+                results.append(self._done.get_nowait())
+        except Empty:
+            pass
+        return results
+
+    def stats(self):
+        with self._lock:
+            waits = list(self._waits)
+            latencies = list(self._latencies)
+            in_flight = self._in_flight
+        return {
+            'in_flight': in_flight,
+            'wait_p50': _percentile(waits, 0.5),
+            'wait_p99': _percentile(waits, 0.99),
+            'latency_p50': _percentile(latencies, 0.5),
+            'latency_p99': _percentile(latencies, 0.99),
+        }
+
+    def stop(self):
+        for thread in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
@@ -1,17 +1,160 @@
+from threading import Lock
+from functools import wraps
 from time import time
+import random
+import sys
+
+
+def _clock_gettime():
+    """ now_ns from clock_gettime(CLOCK_MONOTONIC) through ctypes, or None """
+    clock_id = {'linux': 1, 'darwin': 6}.get(sys.platform.rstrip("0123456789"))
+    if clock_id is None: return None
+    try:
+        import ctypes
+        import ctypes.util
+    except ImportError:
+        return None
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    ## Each call fills its own timespec. Another thread can run between the
+    ## call and reading the fields, so a shared one could be read torn.
+    for name in ("c", "rt"):
+        try:
+            fn = ctypes.PyDLL(ctypes.util.find_library(name) or "lib{0}.so".format(name)).clock_gettime
+        except (OSError, AttributeError):
+            continue
+
+        def now_ns():
+            ts = _timespec()
+            fn(clock_id, ctypes.byref(ts))
+            return ts.tv_sec * 1000000000 + ts.tv_nsec
+
+        return now_ns
+    return None
+
+
+try:
+    from time import monotonic_ns as now_ns
+except ImportError:
+    now_ns = _clock_gettime() or (lambda: int(time() * 1000000000))
+
+
+def now():
+    """ Seconds on the monotonic clock. Only differences are meaningful """
+    return now_ns() / 1e9
+
+
+class LapStats(object):
+    """ Count and mean of every lap, with percentiles over a fixed reservoir.
+
+    The reservoir holds a uniform sample of at most size laps (Vitter's
+    algorithm R), so memory stays flat however many laps are recorded.
+    """
+
+    def __init__(self, size=1024):
+        self._size = size
+        self._samples = []
+        self._lock = Lock()
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def record(self, ns):
+        with self._lock:
+            self.count += 1
+            self.total_ns += ns
+            if ns > self.max_ns: self.max_ns = ns
+            if len(self._samples) < self._size:
+                self._samples.append(ns)
+            else:
+                n = int(random.random() * self.count)
+                if n < self._size: self._samples[n] = ns
+
+    def mean(self):
+        return self.total_ns / 1e9 / self.count if self.count else 0.0
+
+    def percentile(self, pct):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples: return 0.0
+        return samples[min(int(len(samples) * pct), len(samples) - 1)] / 1e9
+
+    def summary(self):
+        """ Returns:
+            A dict of count and mean, p50, p90, p99 and max in seconds
+        """
+        return {
+            'count': self.count,
+            'mean': self.mean(),
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'max': self.max_ns / 1e9,
+        }
+
 
 class StopWatch(object):
-    def __init__(self, seed=0):
-        self._start = seed
+    """ Monotonic timer with nanosecond resolution.
+
+    A StopWatch that was never started peeks as infinitely long ago, so
+    `sw.peek() >= delta` is true on the first check of a polling loop.
+    With reservoir, every lap is also kept in self.stats (a LapStats).
+
+    It also works as a context manager, timing the with block as one lap,
+    and as a decorator, recording every call in self.stats. The decorator keeps
+    its start time per call, so a decorated function can run on many
+    threads at once.
+
+    With clock, laps are measured on clock.now_ns(), so a SimulatedClock
+    times them in simulated time.
+    """
+
+    def __init__(self, started=False, reservoir=0, clock=None):
+        self._now_ns = clock.now_ns if clock else now_ns
+        self._start = self._now_ns() if started else None
+        self.stats = LapStats(reservoir) if reservoir else None
 
     def start(self):
-        self._start = int(time())
+        self._start = self._now_ns()
 
-    def lap(self):
-        s = int(time())
-        r = s - self._start
-        self._start = s
-        return r
+    def peek_ns(self):
+        """ Nanoseconds since the last start or lap, or None if never started """
+        if self._start is None: return None
+        return self._now_ns() - self._start
 
     def peek(self):
-        return int(time()) - self._start
+        """ Seconds since the last start or lap """
+        ns = self.peek_ns()
+        return float("inf") if ns is None else ns / 1e9
+
+    def lap(self):
+        """ Restart the watch and return the seconds it had been running """
+        end = self._now_ns()
+        start, self._start = self._start, end
+        if start is None: return float("inf")
+        if self.stats: self.stats.record(end - start)
+        return (end - start) / 1e9
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = self.lap()
+        return False
+
+    def __call__(self, fn):
+        if not self.stats: self.stats = LapStats()
+        stats = self.stats
+        clock_ns = self._now_ns
+
+        @wraps(fn)
+        def _timed(*args, **kwargs):
+            start = clock_ns()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                stats.record(clock_ns() - start)
+        return _timed
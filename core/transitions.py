@@ -0,0 +1,79 @@
+from threading import Thread, Event, Lock
+import metrics
+import db
+
+
+class TransitionBuffer(object):
+    """ Write-behind buffer for atom state changes.
+
+    Pipeline threads push transitions and move on. The buffer writes them
+    with set_states on model (db.Atom, or db.AccountAtom for accounts) once
+    max_size are waiting, every max_delay seconds, and when stopped. The
+    flush runs on its own session, so the stages never wait on each other
+    for the database. Every push is also timed by metrics.atoms.
+    """
+
+    def __init__(self, dbschema, max_size=50, max_delay=5, model=None):
+        self._dbschema = dbschema
+        self._model = model or db.Atom
+        self._max_size = max_size
+        self._max_delay = max_delay
+        self._pending = []
+        self._lock = Lock()
+        self._wake = Event()
+        self._running = Event()
+        self._thread = None
+
+    def push(self, status, uid, short_link=None):
+        metrics.atoms.transition(uid, status)
+        with self._lock:
+            self._pending.append((status, uid, short_link))
+            full = len(self._pending) >= self._max_size
+        if full: self._wake.set()
+
+    def flush(self):
+        """ Write everything pushed so far. Returns the number of atoms updated
+
+        If the write fails the batch goes back in front of anything pushed
+        since, so the next flush retries it in order.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending: return 0
+
+        session = db.Session(self._dbschema)
+        try:
+            count = self._model.set_states(pending, session)
+            session.commit()
+        except:
+            session.rollback()
+            with self._lock:
+                self._pending[:0] = pending
+            raise
+        finally:
+            session.close()
+        return count
+
+    def _run(self):
+        while self._running.isSet():
+            self._wake.wait(self._max_delay)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print("TRANSITIONS: Flush failed, retrying next time: {0}".format(e))
+
+    def start(self):
+        self._running.set()
+        self._thread = Thread(name="transitionThread", target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the background flush and write whatever is left """
+        self._running.clear()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush()
@@ -2,8 +2,9 @@
 
 from threading import Thread, Event
 from argparse import ArgumentParser, REMAINDER
-from core import Config, db, utils
+from core import Config, db, utils, formatter
 from sys import argv
+from time import time
 import re
 
 def arg_install_db(args, params):
@@ -30,11 +31,17 @@ def arg_genrc(args, params):
     for c in _iter():
         section = c.getSection()
         print("\nConfiguration for section: {0}".format(section))
-        for key, fn_fmt in c.getParams():
+        for param in c.getParams():
+            key, fn_fmt = param[:2]
             print("\n{0}".format(fn_fmt.__doc__))
             while 1:
                 value = raw_input("{0}: ".format(key))
 
+                ## Optional parameters fall back to their default
+                if len(value) == 0 and len(param) > 2:
+                    c.setParam(key, param[2], cp)
+                    break
+
                 ## Verify input was given
                 if len(value) == 0: 
                     print("Please provide a value.")
@@ -63,11 +70,22 @@ def arg_feed(args, params):
         ap.add_argument("-disabled", help="Create the new feed but disable it.", action="store_true")
         ap.add_argument("-tags", help="Hashtags to add to tweets generated from this RSS Feed", nargs="+", type=str)
         ap.add_argument("-order", default=500, help="Adjust the order the feed is checked in relation to other feeds.", type=int)
+        ap.add_argument("-template", help="Tweet layout using {title}, {link} and {tags}.", type=str)
+        ap.add_argument("-timeout", help="Seconds to wait on the feed's server.", type=int)
+        ap.add_argument("-accounts", help="Accounts from [ACCOUNT name] sections that tweet this feed.", nargs="+", type=str)
         ap.add_argument("URL", help="The URL to the Rss Channel you want to create.", type=str)
         _args = ap.parse_args(args)
 
+        for account in _args.accounts or []:
+            if account not in config.accounts:
+                raise KeyError("No [ACCOUNT {0}] section in the configuration".format(account))
+
+        if _args.template:
+            _args.template = _args.template.decode("string_escape")
+            formatter.Template(_args.template)
+
         try:
-            newFeed = db.RssFeed.new(_args.URL, hashtags=_args.tags, order=_args.order, enable=(not _args.disabled))
+            newFeed = db.RssFeed.new(_args.URL, hashtags=_args.tags, order=_args.order, enable=(not _args.disabled), template=_args.template, timeout=_args.timeout, accounts=_args.accounts)
         except KeyError as k:
             raise Exception("This doesn't look like an RSS Feed", k)
 
@@ -134,11 +152,40 @@ def arg_feed(args, params):
             print(" {0:9} : {1}".format("TAGS", feed.hashtags))
             print(" {0:9} : {1}".format("ENABLED",feed.enable))
             print(" {0:9} : {1}".format("ORDER",feed.order))
-            print(" {0:9} : {1}\n".format("ATOMS", len(feed.atoms)))
+            print(" {0:9} : {1!r}".format("TEMPLATE",feed.template or formatter.DEFAULT_TEMPLATE))
+            print(" {0:9} : {1}".format("TIMEOUT",feed.timeout or "default"))
+            print(" {0:9} : {1}".format("ACCOUNTS", " ".join(sorted(s.account for s in feed.subscriptions))))
+            print(" {0:9} : {1}".format("ATOMS", feed.atom_count()))
+            print(" {0:9} : {1}/{2} ({3:.0%})\n".format("CACHE", feed.cache_hits or 0, feed.poll_count or 0, feed.cache_ratio()))
             
         finally:
             session.close()
 
+    def _subscribe(args):
+        ap = ArgumentParser(description="Choose the accounts that tweet a specific RSS Feed.", usage="%(prog)s feed subscribe [options]")
+        ap.add_argument("-remove", help="Unsubscribe the accounts instead.", action="store_true")
+        ap.add_argument("id", help="The ID of the RSS Feed to modify.", type=str)
+        ap.add_argument("accounts", help="Accounts from [ACCOUNT name] sections.", nargs="+", type=str)
+        _args = ap.parse_args(args)
+
+        session = db.Session(config.resources.dbschema)
+        try:
+            feed = session.query(db.RssFeed).filter(db.RssFeed.id == _args.id).first()
+            current = set(s.account for s in feed.subscriptions)
+            for account in _args.accounts:
+                if _args.remove:
+                    feed.subscriptions = [s for s in feed.subscriptions if s.account != account]
+                elif account not in config.accounts:
+                    raise KeyError("No [ACCOUNT {0}] section in the configuration".format(account))
+                elif account not in current:
+                    feed.subscriptions.append(db.FeedAccount(account=account))
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
     def _enable(args):
         ap = ArgumentParser(description="Enable or disable a specific RSS Feed.", usage="%(prog)s feed enable [options]")
         ap.add_argument("-disable", help="Disable the feed.", action="store_false")
@@ -161,6 +208,7 @@ def arg_feed(args, params):
         'search' : _search,
         'detail' : _detail,
         'enable' : _enable,
+        'subscribe' : _subscribe,
     }
 
     ap = ArgumentParser(description="Manage TwitterBot Feeds", usage="%(prog)s feed [options]")
@@ -170,6 +218,60 @@ def arg_feed(args, params):
     _functions[_args.action](_args.args)
 
 
+def arg_atoms(args, params):
+    """ Count atoms and archive old ones """
+
+    config = Config(params.config)
+
+    def _compact(args):
+        ap = ArgumentParser(description="Archive finished atoms to keep the Atom table small.", usage="%(prog)s atoms compact [options]")
+        ap.add_argument("-horizon", help="Archive atoms received more than this many seconds ago.", type=int, default=config.retention.horizon)
+        ap.add_argument("-batch", help="Atoms to archive in each transaction.", type=int, default=config.retention.batch_size)
+        _args = ap.parse_args(args)
+
+        before = int(time()) - _args.horizon
+        archived = purged = 0
+        session = db.Session(config.resources.dbschema)
+        try:
+            while True:
+                atoms, account_atoms = db.compact(session, before, _args.batch)
+                session.commit()
+                if not (atoms or account_atoms): break
+                archived += atoms
+                purged += account_atoms
+                print("Archived {0} atoms and removed {1} account atoms...".format(archived, purged))
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        print("Done. Archived {0} atoms and removed {1} account atoms.".format(archived, purged))
+
+    def _stats(args):
+        ap = ArgumentParser(description="Count the atoms in each status and in the archive.", usage="%(prog)s atoms stats [options]")
+        _args = ap.parse_args(args)
+
+        session = db.Session(config.resources.dbschema)
+        try:
+            for status, count in session.query(db.Atom.status, db.func.count(db.Atom.id)).group_by(db.Atom.status).order_by(db.Atom.status):
+                print(" {0:9} : {1}".format(status, count))
+            print(" {0:9} : {1}".format("ACCOUNT", session.query(db.func.count(db.AccountAtom.id)).scalar()))
+            print(" {0:9} : {1}".format("ARCHIVED", session.query(db.func.count(db.AtomArchive.uniq_id)).scalar()))
+        finally:
+            session.close()
+
+    _functions = {
+        'compact' : _compact,
+        'stats' : _stats,
+    }
+
+    ap = ArgumentParser(description="Manage the TwitterBot atom history", usage="%(prog)s atoms [options]")
+    ap.add_argument("action", help="Select an operation", choices=_functions)
+    ap.add_argument("args", nargs=REMAINDER, help="Arguments for the given operation")
+    _args = ap.parse_args(args)
+    _functions[_args.action](_args.args)
+
+
 def arg_joke(args, params):
 
     config = Config(params.config)
@@ -265,6 +367,7 @@ def main(args):
         "genrc" : arg_genrc,
         "feed" : arg_feed,
         "joke" : arg_joke,
+        "atoms" : arg_atoms,
     }
 
     ap = ArgumentParser(description="RSS Feed TwitterBot", usage="%(prog)s [options]")
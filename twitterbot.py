@@ -1,19 +1,39 @@
 #!/usr/bin/env python2
 from argparse import ArgumentParser, REMAINDER
-from threading import Thread, Event, Lock
-from Queue import Queue, Empty
-from core import db, Config, StopWatch, formatter, Scheduler
-from time import sleep, time
+from threading import Event
+from Queue import Empty
+from heapq import heappush, heappop
+from collections import deque
+from operator import itemgetter
+from os.path import expanduser
+from core import db, httpclient, runtime, accounts, metrics, Config, StopWatch, SystemClock, formatter, Scheduler, Crawler, PollPlanner, TransitionBuffer, Dispatcher, queues, shortener, dynamic
+from core.scheduler import WEEK
+from time import sleep
 from sys import argv as args
 from signal import signal, SIGINT
-import bitly_api
+import multiprocessing
 import twitter
 import socket
+import os
 
 socket.setdefaulttimeout(20)
 
-def feed(config, out_queue, pflag, cflag, session_mutex):
-    sw = StopWatch()
+def _labels(config):
+    """ Metric labels for the stages of one account's pipeline """
+    return {'account': config.account} if config.account else {}
+
+
+def feed(config, out_queue, pflag, cflag, shard=None, router=None, clock=None):
+    """ Poll the feeds and queue their new atoms.
+
+    With accounts, shard is (worker index, worker count) and only that
+    worker's feeds are polled. router then records and sends each new atom
+    to the subscribed accounts instead of out_queue.
+    """
+    clock = clock or SystemClock()
+    sw = StopWatch(clock=clock)
+    crawler = Crawler(config.threads.fetch_concurrency, config.threads.fetch_per_host)
+    planner = PollPlanner(config.threads.poll_min_delta, config.threads.poll_max_delta, config.threads.atom_query_delta)
 
     pflag.wait()
     cflag.set()
@@ -21,26 +41,75 @@ def feed(config, out_queue, pflag, cflag, session_mutex):
     try:
         while pflag.isSet():
 
-            if sw.peek() < config.threads.atom_query_delta:
-                sleep(5)
+            ## This thread's session is closed before any fetch or sleep, so it
+            ## never holds a connection or transaction across network I/O.
+            session = db.Session(config.resources.dbschema)
+
+            ## Pick up feeds that were added or removed while running
+            if sw.peek() >= config.threads.atom_query_delta:
+                sw.lap()
+                planner.sync([feed_id for (feed_id,) in session.query(db.RssFeed.id)
+                              if not shard or accounts.owns_feed(feed_id, *shard)], clock.time())
+                session.commit()
+
+            due = planner.due(clock.time())
+            if not due:
+                session.close()
+                wait = planner.wait(clock.time())
+                clock.sleep(5 if wait is None else min(wait, 5))
                 continue
 
-            sw.lap()
-
-            print("FEED: Checking for new atoms...")
-            with session_mutex:
-                session = db.Session(config.resources.dbschema)
-                for feed in session.query(db.RssFeed).order_by('`order`'):
-                    print("FEED: [{0}] searching...".format(feed.name))
-                    sleep(5)
-                    _atom_count = 0
-                    for atom in feed.get_new_atoms(db.RECIEVED): 
-                        out_queue.put(atom)
-                        session.commit()
-                        _atom_count += 1
-                    print("FEED: [{0}] Found {1} new atoms.".format(feed.name, _atom_count))
+            print("FEED: Checking {0} feeds for new atoms...".format(len(due)))
+            jobs = [(f.id, f.url, f.fetch_options()) for f in session.query(db.RssFeed)
+                    .filter(db.RssFeed.id.in_(due)).order_by(db.RssFeed.order)]
+            session.close()
+
+            results = crawler.fetch(jobs)
+
+            new_atoms = []
+            session = db.Session(config.resources.dbschema)
+            try:
+                for result in results:
+                    feed = session.query(db.RssFeed).get(result.key)
+                    if not feed: continue
+                    if result.error:
+                        print("FEED: [{0}] fetch failed: {1}".format(feed.name, result.error))
+                        metrics.registry.counter("fetch_errors_total").inc()
+                        planner.reschedule(feed.id, clock.time(), error=True)
+                        continue
+                    feed.record_fetch(result)
+                    metrics.registry.histogram("fetch_seconds").observe(result.elapsed)
+                    print("FEED: [{0}] {1} bytes, connect {2:.3f}s, transfer {3:.3f}s.".format(
+                        feed.name, result.bytes, result.connect_time, result.transfer_time))
+                    if result.cache_hit:
+                        print("FEED: [{0}] Unchanged ({1}).".format(feed.name, result.status))
+                        metrics.registry.counter("fetch_cache_hits_total").inc()
+                        planner.reschedule(feed.id, clock.time(), changed=False)
+                        continue
+                    with metrics.registry.histogram("parse_seconds").time():
+                        _atoms = list(feed.get_new_atoms(db.RECIEVED, body=result.body, headers=result.headers,
+                                                         early_stop=config.threads.early_stop))
+                    metrics.registry.counter("atoms_received_total").inc(len(_atoms))
+                    print("FEED: [{0}] Found {1} new atoms in {2:.1f}s.".format(feed.name, len(_atoms), result.elapsed))
+                    new_atoms.extend(_atoms)
+                    delta = planner.reschedule(feed.id, clock.time(), feed.publish_history(), changed=(len(_atoms) > 0))
+                    print("FEED: [{0}] Next poll in {1}s.".format(feed.name, delta))
+                deliveries = router.route(session, new_atoms) if router else None
+                session.commit()
+            except:
+                session.rollback()
+                raise
+            finally:
                 session.close()
-            print("FEED: Sleeping for next cycle")
+
+            if router:
+                router.send(deliveries)
+            else:
+                for atom in new_atoms:
+                    metrics.atoms.received(atom['ident'])
+                    out_queue.put(atom)
+
+            print("FEED: DB pool {0}".format(db.pool_stats(config.resources.dbschema)))
 
     finally:
         print("Exiting Feed Reader")
@@ -48,42 +117,25 @@ def feed(config, out_queue, pflag, cflag, session_mutex):
 
 
 from datetime import datetime
-def schedule(config, in_queue, out_queue, pflag, cflag, session_mutex):
+def _schedule_greedy(config, scheduler, in_queue, out_queue, pflag, transitions, clock):
+    seed = int(clock.time())
 
-    scheduler = Scheduler(config)
-    seed = int(time())
-
-    pflag.wait()
-    cflag.set()
     while pflag.isSet() or not in_queue.empty():
 
-        ## Get scheduling window
-        window_start, window_duration = scheduler.get_next_schedule(seed)
-
-        ## Calculate step between each tweet in window
-        step = window_duration / config.tweet_quota.count
-
-        ## Calculate the new seed and end of this window
-        window_end = seed = window_start + window_duration
-
-        ## Clear the schedule list
-        schedules = []
-
-        ## Fill new schedule list with calculated values
-        for timestamp in range(window_start, window_end, step):
-            schedules.append(timestamp)
+        ## Plan the slots in the next scheduling window(s) and move the seed past them
+        schedules, seed = scheduler.plan(seed, config.tweet_quota.count)
 
         ## Use each schedule in this window but watch for exit notice
         while len(schedules) > 0 and (pflag.isSet() or not in_queue.empty()):
 
-            new_schedule = schedules.pop(0)
+            new_schedule = schedules.popleft()
 
             ## Assign the atom in the queue but verify it will not expire
             ## before it would be sent. If it will, drop it and move on.
             while new_schedule and (pflag.isSet() or not in_queue.empty()):
 
                 ## Verify the schedule is still good. (if the queue blocks and we miss our window)
-                if new_schedule <= int(time()):
+                if new_schedule <= int(clock.time()):
                     new_schedule = None
                     continue
 
@@ -94,156 +146,521 @@ def schedule(config, in_queue, out_queue, pflag, cflag, session_mutex):
                     ## Validate the schedule and skip if it is out of range
                     if new_schedule - i['recv'] > config.tweet_quota.expire_delta:
                         print("SCHEDULER: Atom expired before schedule event.")
-                        with session_mutex:
-                            session = db.Session(config.resources.dbschema)
-                            db.Atom.set_state(db.DROPPED, i['ident'], session)
-                            session.commit()
-                            session.close()
+                        metrics.registry.counter("atoms_dropped_total", reason="expired", **_labels(config)).inc()
+                        transitions.push(db.DROPPED, i['ident'])
+                        in_queue.ack(i['ident'])
                         continue
 
                     ## Schedule was ok, apply it, clear the schedule flag, and queue for tweeting
                     i['schedule'] = new_schedule
                     new_schedule = None
                     
-                    with session_mutex:
-                        session = db.Session(config.resources.dbschema)
-                        db.Atom.set_state(db.SCHEDULED, i['ident'], session)
-                        session.commit()
-                        session.close()
+                    transitions.push(db.SCHEDULED, i['ident'])
 
                     out_queue.put(i)
 
                 except Empty:
                     sleep(0)
 
+
+def _schedule_batch(config, scheduler, in_queue, out_queue, pflag, transitions, clock):
+    seed = int(clock.time())
+    slots = deque()
+    waiting = []
+    starved = False
+
+    while pflag.isSet() or not in_queue.empty() or waiting:
+
+        ## Drain everything that is queued. Atoms still waiting get new slots
+        ## on this pass, so only block when there is nothing to plan for.
+        try:
+            if waiting and not starved:
+                waiting.append(in_queue.get_nowait())
+            else:
+                waiting.append(in_queue.get(timeout=10))
+            while True:
+                waiting.append(in_queue.get_nowait())
+        except Empty:
+            pass
+
+        if not waiting: continue
+
+        ## Make sure every waiting atom has a slot to compete for
+        while len(slots) < len(waiting):
+            more, seed = scheduler.plan(seed, len(waiting) - len(slots))
+            if not more: break
+            slots.extend(more)
+        starved = len(slots) < len(waiting)
+
+        assigned, dropped, waiting = scheduler.assign(waiting, slots, int(clock.time()), config.tweet_quota.expire_delta)
+
+        for i in dropped:
+            print("SCHEDULER: Atom expired before schedule event.")
+            metrics.registry.counter("atoms_dropped_total", reason="expired", **_labels(config)).inc()
+            transitions.push(db.DROPPED, i['ident'])
+            in_queue.ack(i['ident'])
+
+        for new_schedule, i in assigned:
+            i['schedule'] = new_schedule
+            transitions.push(db.SCHEDULED, i['ident'])
+            out_queue.put(i)
+
+
+def _refresh_windows(config, scheduler, pflag, clock):
+    windows = dynamic.DynamicWindows(config.resources.dbschema,
+                                     dynamic.BitlyClickFetcher(config.bitly_keys.user, config.bitly_keys.key),
+                                     config.schedule.dynamic_min_clicks)
+    sw = StopWatch(clock=clock)
+
+    while pflag.isSet():
+
+        if sw.peek() < config.schedule.dynamic_refresh:
+            clock.sleep(5)
+            continue
+
+        sw.lap()
+
+        try:
+            print("SCHEDULER: Stored {0} new click records".format(windows.refresh(int(clock.time()))))
+            found = windows.windows(config.schedule.dynamic_windows, config.schedule.window_duration)
+        except Exception as e:
+            print("SCHEDULER: Click refresh failed: {0}".format(e))
+            continue
+
+        if found:
+            print("SCHEDULER: Using {0} windows from click history".format(len(found)))
+            scheduler.use_windows(found, WEEK)
+        else:
+            print("SCHEDULER: Not enough click history, using the configured windows")
+            scheduler.use_static()
+
+
+def compact(config, pflag, clock=None):
+    """ Archive finished atoms older than config.retention.horizon every compact_delta seconds """
+    clock = clock or SystemClock()
+    sw = StopWatch(clock=clock)
+    pflag.wait()
+
+    while pflag.isSet():
+
+        if sw.peek() < config.retention.compact_delta:
+            clock.sleep(5)
+            continue
+
+        sw.lap()
+        archived = purged = 0
+        session = db.Session(config.resources.dbschema)
+        try:
+            before = int(clock.time()) - config.retention.horizon
+            while pflag.isSet():
+                atoms, account_atoms = db.compact(session, before, config.retention.batch_size)
+                session.commit()
+                if not (atoms or account_atoms): break
+                archived += atoms
+                purged += account_atoms
+        except Exception as e:
+            print("COMPACT: Failed: {0}".format(e))
+            session.rollback()
+        finally:
+            session.close()
+
+        metrics.registry.counter("atoms_archived_total").inc(archived)
+        print("COMPACT: Archived {0} atoms and removed {1} account atoms".format(archived, purged))
+
+
+def schedule(config, in_queue, out_queue, pflag, cflag, transitions, clock=None):
+
+    clock = clock or SystemClock()
+    scheduler = Scheduler(config)
+
+    pflag.wait()
+    cflag.set()
+
+    if config.schedule.dynamic_enabled:
+        clock.spawn("windowThread", _refresh_windows, dict(config=config, scheduler=scheduler, pflag=pflag, clock=clock), daemon=True)
+
+    if config.schedule.batch_enabled:
+        _schedule_batch(config, scheduler, in_queue, out_queue, pflag, transitions, clock)
+    else:
+        _schedule_greedy(config, scheduler, in_queue, out_queue, pflag, transitions, clock)
+
     print("Exiting Scheduler")
     cflag.clear()
 
 
-def fmt(config, in_queue, out_queue, pflag, cflag, session_mutex):
-    x = []
+def fmt(config, in_queue, out_queue, pflag, cflag, transitions, link_cache=None, clock=None):
     pflag.wait()
     cflag.set()
 
-    _bitly = bitly_api.Connection(config.bitly_keys.user, access_token=config.bitly_keys.key)
+    _shortener = link_cache or shortener.ShortLinkCache(shortener.from_config(config), config.resources.dbschema,
+                                                        config.bitly_keys.cache_size, config.bitly_keys.cache_ttl)
+    pool = shortener.ShortenerPool(_shortener, config.bitly_keys.workers, config.bitly_keys.retries, clock=clock)
 
-    while pflag.isSet() or not in_queue.empty():
+    ## Atoms waiting on a short link, released in schedule order
+    pending = []
+    atoms = {}
+    seq = 0
+
+    while pflag.isSet() or not in_queue.empty() or pending:
         try:
-            i = in_queue.get(timeout=10)
+            i = in_queue.get(timeout=(0.1 if pending else 10))
             print("FORMATTER: Recieving new atom")
 
-            ## Get Bitly Address
-            bitly_short_link = _bitly.shorten(i['link'])
-            if not bitly_short_link: continue
+            if 'msg' in i:
+                ## Formatted before a restart and rescheduled by recover_queues
+                transitions.push(db.FORMATTED, i['ident'])
+                out_queue.put((i['msg'], i['schedule'], i['ident']))
+            else:
+                ## Get Bitly Address
+                atoms[i['ident']] = i
+                heappush(pending, (i['schedule'], seq, i['ident']))
+                seq += 1
+                pool.submit(i['ident'], i['link'])
 
-            i['short_link'] = bitly_short_link['url']
+        except Empty:
+            sleep(0)
 
-            msg = formatter.format_atom(i, config)
+        for ident, short_link in pool.completed():
+            atoms[ident]['short_link'] = short_link
 
-            with session_mutex:
-                session = db.Session(config.resources.dbschema)
-                db.Atom.set_state(db.FORMATTED, i['ident'], session)
-                db.Atom.set_bitly(i['short_link'], i['ident'], session)
-                session.commit()
-                session.close()
+        released = 0
+        while pending and 'short_link' in atoms[pending[0][2]]:
+            i = atoms.pop(heappop(pending)[2])
+            if not i['short_link']:
+                metrics.registry.counter("atoms_dropped_total", reason="shorten_failed", **_labels(config)).inc()
+                transitions.push(db.DROPPED, i['ident'])
+                in_queue.ack(i['ident'])
+                continue
+
+            with metrics.registry.histogram("format_seconds", **_labels(config)).time():
+                msg = formatter.format_atom(i, config)
+
+            transitions.push(db.FORMATTED, i['ident'], i['short_link'])
 
             out_queue.put((msg, i['schedule'], i['ident']))
+            released += 1
 
-        except Empty:
-            sleep(0)
+        if released:
+            print("FORMATTER: Shortener {0}".format(pool.stats()))
 
+    pool.stop()
     print("Exiting Formatter")
     cflag.clear()
 
 
-def tweet(config, in_queue, flag, session_mutex):
+def tweet(config, in_queue, flag, transitions, clock=None):
 
+    clock = clock or SystemClock()
     oauth_token, oauth_secret = twitter.read_token_file(config.twitter_keys.cred_path)
-    _twitter = twitter.Twitter(auth=twitter.OAuth(oauth_token, oauth_secret, config.twitter_keys.key, config.twitter_keys.secret))
+    _twitter = twitter.Twitter(auth=twitter.OAuth(oauth_token, oauth_secret, config.twitter_keys.key, config.twitter_keys.secret),
+                               domain=config.twitter_keys.domain, secure=config.twitter_keys.secure)
     
     def send_tweet(body):
         print("TWEET: Posting tweet...")
-        _twitter.statuses.update(status=body)
+        try:
+            with metrics.registry.histogram("post_seconds", **_labels(config)).time():
+                _twitter.statuses.update(status=body)
+        except Exception as e:
+            print("TWEET: Post failed: {0}".format(e))
+            metrics.registry.counter("post_errors_total", **_labels(config)).inc()
+            return False
+        metrics.registry.counter("tweets_posted_total", **_labels(config)).inc()
         print("TWEET: Complete")
+        return True
         
-    count = 0
-    flag.wait()
-    while flag.isSet() or not in_queue.empty():
-        try:
-            msg, schedule, uid = in_queue.get(timeout=10)
-            count += 1
+    dispatcher = Dispatcher(clock)
+    metrics.registry.gauge("queue_depth", dispatcher.__len__, stage="dispatch", **_labels(config))
+
+    def _collect():
+        while flag.isSet() or not in_queue.empty():
+            try:
+                msg, schedule, uid = in_queue.get(timeout=10)
+            except Empty:
+                continue
 
             print("\nTWEET ATOM: {0}".format(datetime.fromtimestamp(schedule).strftime("%H:%M:%S %m-%d-%Y")))
 
-            with session_mutex:
-                session = db.Session(config.resources.dbschema)
-                db.Atom.set_state(db.WAIT, uid, session)
-                session.commit()
-                session.close()
+            transitions.push(db.WAIT, uid)
+            dispatcher.push(schedule, (msg, uid))
 
-            ## Wait for schedule it hit
-            while int(time()) < schedule:
-                if not flag.isSet(): 
-                    print("TWEET: Warning: Exiting with scheduled tweets. Oh well")
-                    return
-                else:
-                    sleep(1)
+        if len(dispatcher):
+            print("TWEET: Warning: Exiting with scheduled tweets. Oh well")
+        dispatcher.close()
 
-            send_tweet(msg)
+    count = 0
+    flag.wait()
 
-            with session_mutex:
-                session = db.Session(config.resources.dbschema)
-                db.Atom.set_state(db.SENT, uid, session)
+    ## Atoms are collected on their own thread so a far off schedule never
+    ## holds up the ones behind it.
+    collector = clock.spawn("tweetCollectThread", _collect)
+
+    while True:
+        entry = dispatcher.next()
+        if entry is None: break
+        msg, uid = entry
+        count += 1
+
+        ## A failed post is not retried. Its slot has passed
+        if send_tweet(msg):
+            transitions.push(db.SENT, uid)
+        else:
+            metrics.registry.counter("atoms_dropped_total", reason="post_failed", **_labels(config)).inc()
+            transitions.push(db.DROPPED, uid)
+        in_queue.ack(uid)
+
+        clock.sleep(config.tweet_quota.delta)
+
+        if (count % config.tweet_quota.joke_align) == 0:
+
+            ## Claim the joke first and post it after the session is closed
+            session = db.Session(config.resources.dbschema)
+            try:
+                joke = db.Joke.get_next(session)
+                body = joke.body if joke else None
                 session.commit()
+            except:
+                session.rollback()
+                raise
+            finally:
                 session.close()
 
-            sleep(config.tweet_quota.delta)
-
-            if (count % config.tweet_quota.joke_align) == 0:
+            if body:
+                print("SENDING A JOKE")
+                send_tweet(body)
+                clock.sleep(config.tweet_quota.delta)
 
-                with session_mutex:
-                    session = db.Session(config.resources.dbschema)
-                    joke = db.Joke.get_next(session)
-                    if joke:
-                        print("SENDING A JOKE")
-                        send_tweet(joke.body)
-                        session.commit()
-                        sleep(config.tweet_quota.delta)
-                    session.close()
-
-        except Empty:
-            sleep(0)
+    collector.join()
     
     print("Exiting Tweet Engine.")
 
 
-def create_thread_plan(config):
-    pFlag = Event()
-    schdFlag = Event()
+def recover_queues(config, store, transitions, model=db.Atom, names=None, clock=None):
+    """ Resume the atoms a previous run left in the pipeline
+
+    Atoms past their expire_delta are dropped. Atoms whose slot passed while
+    the pipeline was down go back to the schedule queue for a new one, so a
+    restart never posts them all at once.
+
+    With accounts, model is db.AccountAtom and names are the accounts whose
+    queues are kept in store.
+    """
+    clock = clock or SystemClock()
+    count = store.recover()
+    if count: print("RECOVERY: Resuming {0} stored atoms".format(count))
+
+    ## Atoms in flight without a stored payload can't be rebuilt into a tweet
+    queued = store.keys()
+    session = db.Session(config.resources.dbschema)
+    try:
+        query = session.query(model.uniq_id, model.recv_dts).filter(model.status.in_([db.RECIEVED, db.SCHEDULED, db.FORMATTED, db.WAIT]))
+        if names is not None: query = query.filter(model.account.in_(names))
+        live = dict(query)
+    finally:
+        session.close()
+    stuck = [uid for uid in live if uid not in queued]
+
+    for uid in stuck:
+        transitions.push(db.DROPPED, uid)
+    metrics.registry.counter("atoms_dropped_total", reason="no_payload").inc(len(stuck))
+    if stuck: print("RECOVERY: Dropping {0} atoms with no stored payload".format(len(stuck)))
+
+    with store.cond:
+        stored = [(key, store.items[key], store.payloads[key]) for key in store.items]
+
+    now = int(clock.time())
+    finished = expired = rescheduled = 0
+    for key, queue, item in stored:
+        stage = queue.rsplit(":", 1)[-1]
+        prefix = queue[:-len(stage)]
+        _config = config.for_account(prefix[:-1]) if prefix else config
+        schdQueue = queues.DurableQueue(store, prefix + "schedule", itemgetter('ident'))
+
+        ## Finished before the restart, and only its ack was lost
+        if key not in live:
+            schdQueue.ack(key)
+            finished += 1
+            continue
+
+        if live[key] + _config.tweet_quota.expire_delta <= now:
+            metrics.registry.counter("atoms_dropped_total", reason="expired", **_labels(_config)).inc()
+            transitions.push(db.DROPPED, key)
+            schdQueue.ack(key)
+            expired += 1
+            continue
+
+        if stage == "format" and item['schedule'] <= now:
+            item = dict(item)
+            del item['schedule']
+        elif stage == "tweet" and item[1] <= now:
+            ## The atom is already formatted. fmt passes msg through as is
+            item = {'ident': key, 'recv': live[key], 'msg': item[0]}
+        else:
+            continue
+        schdQueue.put(item)
+        rescheduled += 1
+
+    if finished: print("RECOVERY: Forgetting {0} atoms that were already finished".format(finished))
+    if expired: print("RECOVERY: Dropping {0} expired atoms".format(expired))
+    if rescheduled: print("RECOVERY: Rescheduling {0} atoms whose slot has passed".format(rescheduled))
+
+
+def _stage_queue(config, store, name, key, clock=None):
+    if store: return queues.DurableQueue(store, name, key, maxsize=config.threads.queue_size)
+    return queues.MemoryQueue(maxsize=config.threads.queue_size, clock=clock)
+
+
+def _pipeline(config, store, schdFlag, transitions, link_cache=None, prefix="", clock=None):
+    """ The schedule, format and tweet stages fed from the returned schedule queue """
     fmtFlag = Event()
     tweetFlag = Event()
-    session_lock = Lock()
-
-    schdQueue = Queue(maxsize=config.threads.queue_size)
-    fmtQueue = Queue(maxsize=config.threads.queue_size)
-    tweetQueue = Queue(maxsize=config.threads.queue_size)
+    schdQueue = _stage_queue(config, store, prefix + "schedule", itemgetter('ident'), clock)
+    fmtQueue = _stage_queue(config, store, prefix + "format", itemgetter('ident'), clock)
+    tweetQueue = _stage_queue(config, store, prefix + "tweet", itemgetter(2), clock)
+    for stage, queue in (("schedule", schdQueue), ("format", fmtQueue), ("tweet", tweetQueue)):
+        metrics.registry.gauge("queue_depth", queue.qsize, stage=stage, **_labels(config))
 
     return {
-        'feedThread': ( feed, dict( config=config, out_queue=schdQueue, pflag=pFlag, cflag=schdFlag, session_mutex=session_lock )),
-        'schdThread': ( schedule, dict( config=config, in_queue=schdQueue, out_queue=fmtQueue, 
-                                        pflag=schdFlag, cflag=fmtFlag, session_mutex=session_lock )),
-        'fmtThread': ( fmt, dict( config=config, in_queue=fmtQueue, out_queue=tweetQueue, 
-                                  pflag=fmtFlag, cflag=tweetFlag, session_mutex=session_lock )),
-        'tweetThread': ( tweet, dict( config=config, in_queue=tweetQueue, flag=tweetFlag, session_mutex=session_lock )),
-    }, pFlag
+        prefix + 'schdThread': ( schedule, dict( config=config, in_queue=schdQueue, out_queue=fmtQueue, 
+                                                 pflag=schdFlag, cflag=fmtFlag, transitions=transitions, clock=clock )),
+        prefix + 'fmtThread': ( fmt, dict( config=config, in_queue=fmtQueue, out_queue=tweetQueue, 
+                                           pflag=fmtFlag, cflag=tweetFlag, transitions=transitions, link_cache=link_cache, clock=clock )),
+        prefix + 'tweetThread': ( tweet, dict( config=config, in_queue=tweetQueue, flag=tweetFlag, transitions=transitions, clock=clock )),
+    }, schdQueue
+
+
+def create_thread_plan(config, clock=None):
+    """ The threads of the single account pipeline.
+
+    clock, when given, replaces the system clock in the feed stage's poll
+    planning, the schedule stage and its window refresh, the format stage's
+    shortener workers, the tweet stage and compaction. Atom recv stamps,
+    the short link cache and rate limit, and the durable queues still read
+    the system clock.
+    """
+    pFlag = Event()
+    schdFlag = Event()
+    transitions = TransitionBuffer(config.resources.dbschema, config.threads.flush_size, config.threads.flush_delta)
+    store = queues.QueueStore(expanduser(config.threads.queue_path)) if config.threads.queue_path else None
+
+    plan, schdQueue = _pipeline(config, store, schdFlag, transitions, clock=clock)
+    plan['feedThread'] = ( feed, dict( config=config, out_queue=schdQueue, pflag=pFlag, cflag=schdFlag, clock=clock ))
+    if config.retention.compact_delta:
+        plan['compactThread'] = ( compact, dict( config=config, pflag=pFlag, clock=clock ))
+
+    if store: recover_queues(config, store, transitions, clock=clock)
+    return plan, pFlag, transitions
+
+
+def route(inbox, targets, pflag):
+    """ Hand atoms from every worker's feed stage to this worker's accounts
+
+    targets maps an account name to its (schedule queue, schedule flag).
+    """
+    pflag.wait()
+    for in_queue, flag in targets.values(): flag.set()
+
+    try:
+        while pflag.isSet():
+            try:
+                account, item = inbox.get(timeout=1)
+            except Empty:
+                continue
+            metrics.atoms.received(item['ident'])
+            targets[account][0].put(item)
+    finally:
+        print("Exiting Router")
+        for in_queue, flag in targets.values(): flag.clear()
+
+
+def create_worker_plan(config, index, inboxes):
+    """ The threads of one supervisor worker process.
+
+    The worker polls its shard of the feeds for every account and runs the
+    schedule, format and tweet stages of the accounts it owns. Its accounts
+    share one short link cache, and every worker shares the database layer
+    of that cache.
+    """
+    workers = len(inboxes)
+    names = accounts.owned(config.accounts, index, workers)
+    pFlag = Event()
+    transitions = TransitionBuffer(config.resources.dbschema, config.threads.flush_size, config.threads.flush_delta,
+                                   model=db.AccountAtom)
+    store = None
+    if config.threads.queue_path:
+        store = queues.QueueStore(expanduser("{0}.{1}".format(config.threads.queue_path, index)))
+    link_cache = shortener.ShortLinkCache(shortener.from_config(config, workers), config.resources.dbschema,
+                                          config.bitly_keys.cache_size, config.bitly_keys.cache_ttl)
+
+    plan = {}
+    targets = {}
+    for name in names:
+        schdFlag = Event()
+        stages, schdQueue = _pipeline(config.for_account(name), store, schdFlag, transitions, link_cache, name + ":")
+        plan.update(stages)
+        targets[name] = (schdQueue, schdFlag)
+
+    plan['feedThread'] = ( feed, dict( config=config, out_queue=None, pflag=pFlag, cflag=Event(), shard=(index, workers),
+                                       router=accounts.AccountRouter(config.accounts, inboxes) ))
+    plan['routeThread'] = ( route, dict( inbox=inboxes[index], targets=targets, pflag=pFlag ))
+
+    ## The archive is shared, so only the first worker compacts it
+    if config.retention.compact_delta and index == 0:
+        plan['compactThread'] = ( compact, dict( config=config, pflag=pFlag ))
+
+    if store: recover_queues(config, store, transitions, db.AccountAtom, names)
+    return plan, pFlag, transitions
+
+
+def run_worker(config, index, inboxes):
+    tp, pflag, transitions = create_worker_plan(config, index, inboxes)
+    print("WORKER {0}: Running {1} stage threads".format(index, len(tp)))
+    start_metrics(config, index, "WORKER {0} METRICS".format(index))
+
+    signal(SIGINT, __signal(pflag))
+
+    transitions.start()
+    th = start_threads(tp)
+    pflag.set()
+
+    wait_threads(th)
+    transitions.stop()
 
 
-def start_threads(thread_plan):
+def supervise(config):
+    """ Run every [ACCOUNT name] section across config.threads.workers processes """
+    workers = max(min(config.threads.workers, len(config.accounts)), 1)
+    inboxes = [multiprocessing.Queue() for n in range(workers)]
+    procs = [multiprocessing.Process(name="worker{0}".format(n), target=run_worker, args=(config, n, inboxes))
+             for n in range(workers)]
+
+    def _forward(signum, frame):
+        print("\b\bCaught signal. Stopping workers...")
+        for proc in procs:
+            if proc.is_alive(): os.kill(proc.pid, SIGINT)
+
+    for proc in procs: proc.start()
+    signal(SIGINT, _forward)
+    print("SUPERVISOR: {0} accounts on {1} workers".format(len(config.accounts), workers))
+
+    for proc in procs:
+        while proc.is_alive():
+            sleep(1)
+
+
+def start_metrics(config, offset=0, prefix="METRICS"):
+    """ Serve the metrics over HTTP and log them as configured in [METRICS] """
+    if config.metrics.port:
+        metrics.serve(metrics.registry, config.metrics.port + offset, config.metrics.bind)
+        print("{0}: Serving http://{1}:{2}/metrics".format(prefix, config.metrics.bind, config.metrics.port + offset))
+    if config.metrics.log_delta:
+        metrics.log_periodically(metrics.registry, config.metrics.log_delta, prefix)
+
+
+def start_threads(thread_plan, clock=None):
+    clock = clock or SystemClock()
     threads = []
     for tname,(fn,kwargs) in thread_plan.items():
-        newThread = Thread(name=tname, kwargs=kwargs, target=fn)
-        threads.append(newThread)
-        newThread.start()
+        threads.append(clock.spawn(tname, fn, kwargs))
     return threads
 
 
@@ -263,15 +680,35 @@ def __signal(pflag):
 if __name__ == "__main__":
     ap = ArgumentParser(description="RSS Feed TwitterBot", usage="%(prog)s [options]")
     ap.add_argument("-config", help="Specify the config file to use.", type=str, default='~/.twitterbotrc')
+    ap.add_argument("-runtime", help="Override how the pipeline stages run.", choices=runtime.RUNTIMES)
     _args = ap.parse_args(args[1:])
     config = Config(_args.config)
 
-    tp, pflag = create_thread_plan(config)
+    runtime.ensure(_args.runtime or config.threads.runtime, args)
+    print("Running the pipeline on {0}".format(runtime.active()))
 
-    signal(SIGINT, __signal(pflag))
+    db.configure(config.resources.dbschema,
+        pool_size=config.db.pool_size,
+        max_overflow=config.db.max_overflow,
+        pool_recycle=config.db.pool_recycle)
 
-    th = start_threads(tp)
-    pflag.set()
+    httpclient.configure(
+        max_per_host=config.threads.fetch_per_host,
+        timeout=config.threads.fetch_timeout,
+        max_body=config.threads.fetch_max_body)
 
-    wait_threads(th)
+    if config.accounts:
+        supervise(config)
+    else:
+        tp, pflag, transitions = create_thread_plan(config)
+        start_metrics(config)
+
+        signal(SIGINT, __signal(pflag))
+
+        transitions.start()
+        th = start_threads(tp)
+        pflag.set()
+
+        wait_threads(th)
+        transitions.stop()
 